@@ -1,32 +1,98 @@
+import json
 import sqlite3
 import threading
+import time
 import queue
+from collections import deque
+from Log import log
 from Message import Message
+from Stats import stats
+
+HISTORY_NUMERICS = {"JOIN", "PRIVMSG", "421", "366", "353", "001"}
+
+
+def is_history_command(command) -> bool:
+    # Named commands always count, numerics only when whitelisted
+    return bool(command) and (any(c.isupper() for c in command) or command in HISTORY_NUMERICS)
+
+
+class HistoryCache:
+    # Bounded per-(network, channel) ring buffers of recent messages, newest
+    # last. (network, None) holds the most recent messages of a whole network.
+    def __init__(self, capacity: int = 200) -> None:
+        self.capacity = capacity
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def add(self, message: Message) -> None:
+        if not is_history_command(message.command):
+            return
+        with self.lock:
+            for key in ((message.network, None), (message.network, message.channel)):
+                buffer = self.buffers.get(key)
+                if buffer is None:
+                    buffer = self.buffers[key] = deque(maxlen=self.capacity)
+                buffer.append(message)
+
+    def fill(self, network: str, channel, messages) -> None:
+        # Seeds a buffer from disk, oldest first, unless it already holds more
+        with self.lock:
+            buffer = self.buffers.get((network, channel))
+            if buffer is not None and len(buffer) >= len(messages):
+                return
+            self.buffers[(network, channel)] = deque(messages, maxlen=self.capacity)
+
+    def get(self, context_window: int, channel=None, network="") -> list:
+        with self.lock:
+            buffer = self.buffers.get((network, channel))
+            if not buffer:
+                return []
+            start = max(len(buffer) - context_window, 0)
+            return [buffer[i] for i in range(len(buffer) - 1, start - 1, -1)]
+
 
 class Database:
     _instance = None
     _lock = threading.Lock()
 
-    def __new__(cls, db_path: str = "chat.db"):
+    def __new__(cls, db_path: str = "chat.db", history_size: int = 200, warm_rows: int = 5000,
+                batch_size: int = 500, batch_wait_ms: int = 50):
         with cls._lock:
             if cls._instance is None:
                 cls._instance = super(Database, cls).__new__(cls)
                 cls._instance._initialized = False
         return cls._instance
 
-    def __init__(self, db_path: str = "chat.db"):
+    def __init__(self, db_path: str = "chat.db", history_size: int = 200, warm_rows: int = 5000,
+                 batch_size: int = 500, batch_wait_ms: int = 50):
         if self._initialized:
             return
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+
         self.write_conn = sqlite3.connect(db_path, check_same_thread=False)
         self.write_conn.row_factory = sqlite3.Row
+        # Only takes effect on a new, empty file, and must come before WAL
+        # mode initializes it; existing files are left as they are
+        self.write_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._configure(self.write_conn)
         self.write_cursor = self.write_conn.cursor()
 
         self.read_conn = sqlite3.connect(db_path, check_same_thread=False)
         self.read_conn.row_factory = sqlite3.Row
+        self._configure(self.read_conn)
         self.read_cursor = self.read_conn.cursor()
         self.read_lock = threading.Lock()
 
-        self._create_tables()
+        self._migrate()
+        self.fts_enabled = self.write_conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone() is not None
+        self.ts_lock = threading.Lock()
+        self.last_ts = self.write_conn.execute("SELECT COALESCE(MAX(ts), 0) FROM messages").fetchone()[0]
+
+        self.history = HistoryCache(capacity=history_size)
+        self._warm_history(warm_rows)
 
         self.write_queue = queue.Queue()
         self.running = True
@@ -35,7 +101,35 @@ class Database:
 
         self._initialized = True
 
-    def _create_tables(self):
+    @staticmethod
+    def _configure(conn):
+        # WAL lets the read connection see committed rows while the writer works
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+
+    def _migrate(self):
+        # PRAGMA user_version records the last migration applied to this file
+        version = self.write_conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, migration in enumerate(self.MIGRATIONS, start=1):
+            if version >= target:
+                continue
+            # sqlite3 only opens transactions implicitly for DML, so ALTER and
+            # CREATE would autocommit; an explicit BEGIN makes the schema
+            # changes, the backfill and the version bump one unit
+            self.write_conn.execute("BEGIN")
+            try:
+                migration(self)
+                self.write_conn.execute(f"PRAGMA user_version = {target}")
+                self.write_conn.commit()
+            except BaseException:
+                self.write_conn.rollback()
+                raise
+            version = target
+
+    def _migrate_v1(self):
         self.write_cursor.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -60,65 +154,297 @@ class Database:
         #         FOREIGN KEY (message_id) REFERENCES messages(id)
         #     )
         # """)
-        #
-        self.write_conn.commit()
+
+    def _migrate_v2(self):
+        # channel and in_history are derived once at write time, ts is a
+        # microsecond timestamp; legacy rows only get second resolution.
+        self.write_cursor.execute("ALTER TABLE messages ADD COLUMN channel TEXT NOT NULL DEFAULT ''")
+        self.write_cursor.execute("ALTER TABLE messages ADD COLUMN ts INTEGER NOT NULL DEFAULT 0")
+        self.write_cursor.execute("ALTER TABLE messages ADD COLUMN in_history INTEGER NOT NULL DEFAULT 0")
+        self.write_conn.create_function(
+            "irc_channel", 3,
+            lambda command, middle_params, trailing: Message(
+                command=command, middle_params=middle_params, trailing=trailing).channel,
+            deterministic=True)
+        self.write_conn.create_function("irc_in_history", 1, lambda command: int(is_history_command(command)),
+                                        deterministic=True)
+        self.write_cursor.execute("""
+            UPDATE messages SET
+                channel = irc_channel(command, middle_params, trailing),
+                in_history = irc_in_history(command),
+                ts = CAST(strftime('%s', timestamp) AS INTEGER) * 1000000
+        """)
+        self.write_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel, id)")
+        self.write_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_command ON messages (command, id)")
+        self.write_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_history ON messages (channel, id) WHERE in_history = 1")
+
+    def _migrate_v3(self):
+        # Older parsers stored missing fields as the literal string 'None'
+        self.write_cursor.execute("""
+            UPDATE messages SET
+                tags = NULLIF(tags, 'None'),
+                nick = NULLIF(nick, 'None'),
+                user = NULLIF(user, 'None'),
+                host = NULLIF(host, 'None'),
+                middle_params = NULLIF(middle_params, 'None'),
+                trailing = NULLIF(trailing, 'None')
+            WHERE 'None' IN (tags, nick, user, host, middle_params, trailing)
+        """)
+
+    def _migrate_v4(self):
+        # Rows written before multi-network support belong to the default network
+        self.write_cursor.execute("ALTER TABLE messages ADD COLUMN network TEXT NOT NULL DEFAULT ''")
+        self.write_cursor.execute("DROP INDEX IF EXISTS idx_messages_history")
+        self.write_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_history ON messages (network, channel, id) WHERE in_history = 1")
+
+    def _migrate_v5(self):
+        # Retention selects by age; without this every pass scans the table
+        self.write_cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts)")
+
+    def _migrate_v6(self):
+        # Full-text index over conversation lines. Triggers keep it in step
+        # with the batched inserts of the write worker and with retention
+        # deletes; SQLite builds without FTS5 simply run without retrieval.
+        try:
+            self.write_cursor.execute(
+                "CREATE VIRTUAL TABLE messages_fts USING fts5(trailing, nick, content='messages', content_rowid='id')")
+        except sqlite3.OperationalError as e:
+            log.warning("db", "db.fts_unavailable", error=str(e))
+            return
+        self.write_cursor.execute("""
+            CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+            WHEN new.in_history = 1 AND new.trailing IS NOT NULL
+            BEGIN
+                INSERT INTO messages_fts (rowid, trailing, nick) VALUES (new.id, new.trailing, new.nick);
+            END
+        """)
+        self.write_cursor.execute("""
+            CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+            WHEN old.in_history = 1 AND old.trailing IS NOT NULL
+            BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, trailing, nick)
+                VALUES ('delete', old.id, old.trailing, old.nick);
+            END
+        """)
+        self.write_cursor.execute("""
+            INSERT INTO messages_fts (rowid, trailing, nick)
+            SELECT id, trailing, nick FROM messages WHERE in_history = 1 AND trailing IS NOT NULL
+        """)
+
+    def _migrate_v7(self):
+        # Nick and joined channels per network, restored after restarts
+        self.write_cursor.execute("""
+            CREATE TABLE IF NOT EXISTS connection_state (
+                network TEXT PRIMARY KEY,
+                nick TEXT,
+                channels TEXT NOT NULL DEFAULT '[]',
+                ts INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7]
+
+    def _next_ts(self) -> int:
+        with self.ts_lock:
+            self.last_ts = max(time.time_ns() // 1000, self.last_ts + 1)
+            return self.last_ts
 
     def _process_writes(self):
-        while self.running:
+        while self.running or not self.write_queue.empty():
             try:
-                func, args, kwargs = self.write_queue.get(timeout=1)
-                func(*args, **kwargs)
-                self.write_conn.commit()
-                self.write_queue.task_done()
+                batch = [self.write_queue.get(timeout=1)]
             except queue.Empty:
                 continue
-            except Exception as e:
-                print(e)
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size and batch[-1][0] != "flush":
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self.write_queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
 
-    def add_message(self, message: Message):
-        def _insert(msg: Message):
-            self.write_cursor.execute(
-                "INSERT INTO messages (full_text, tags, nick, user, host, command, middle_params, trailing) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (msg.full_text, msg.tags, msg.nick, msg.user, msg.host, msg.command,
-                 msg.middle_params, msg.trailing),
-            )
+    def _write_batch(self, batch):
+        # One transaction per batch; consecutive rows for the same statement
+        # go through a single executemany call.
+        barriers = []
+        groups = []
+        for kind, payload, params, _ in batch:
+            if kind == "flush":
+                barriers.append(payload)
+            elif groups and groups[-1][0] == payload:
+                groups[-1][1].append(params)
+            else:
+                groups.append((payload, [params]))
+        started = time.monotonic() if stats.enabled else None
+        try:
+            with self.write_conn:
+                for sql, rows in groups:
+                    self.write_cursor.executemany(sql, rows)
+        except Exception as e:
+            log.error("db", "db.write_failed", rows=sum(len(rows) for _, rows in groups), error=str(e))
+        finally:
+            if started is not None:
+                stats.observe("db_queue", None, started - min(item[3] for item in batch))
+                stats.observe("db_commit", None, time.monotonic() - started)
+                stats.incr("db.rows", sum(len(rows) for _, rows in groups))
+                stats.incr("db.batches")
+            for barrier in barriers:
+                barrier.set()
+            for _ in batch:
+                self.write_queue.task_done()
 
-        self.write_queue.put((_insert, (message,), {}))
+    def flush(self, timeout=None) -> bool:
+        # Returns once everything queued before the call has been committed
+        barrier = threading.Event()
+        self.write_queue.put(("flush", barrier, None, time.monotonic()))
+        return barrier.wait(timeout)
 
-    def get_message_history(self, context_window: int = 10):
-        allowed_commands = {"JOIN", "PRIVMSG", "421", "366", "353", "001"}
+    def _warm_history(self, warm_rows: int):
         with self.read_lock:
             self.read_cursor.execute(
-                """
-                SELECT * FROM messages
-                WHERE 
-                    (command GLOB '*[A-Z]*')
-                    OR
-                    command IN ({})
-                ORDER BY timestamp DESC
-                LIMIT ?
-                """.format(",".join("?" * len(allowed_commands))),
-                (*allowed_commands, context_window),
-            )
+                "SELECT * FROM messages WHERE in_history = 1 ORDER BY id DESC LIMIT ?", (warm_rows,))
             rows = self.read_cursor.fetchall()
-            messages = []
-            for row in rows:
-                msg = Message(
-                    full_text=row["full_text"],
-                    tags=row["tags"],
-                    nick=row["nick"],
-                    user=row["user"],
-                    host=row["host"],
-                    command=row["command"],
-                    middle_params=row["middle_params"],
-                    trailing=row["trailing"]
-                )
-                messages.append(msg)
-            return messages
-
-    def stop(self):
+        for row in reversed(rows):
+            self.history.add(self._row_to_message(row))
+
+    @staticmethod
+    def _row_to_message(row) -> Message:
+        msg = Message(
+            full_text=row["full_text"] or "",
+            tags=row["tags"],
+            nick=row["nick"],
+            user=row["user"],
+            host=row["host"],
+            command=row["command"],
+            middle_params=row["middle_params"],
+            trailing=row["trailing"]
+        )
+        msg.network = row["network"]
+        if row["channel"] and not msg.channel:
+            # Private conversations are stored under the other party's nick
+            msg.query = row["channel"]
+        if not msg.full_text:
+            # Compacted rows only keep the parsed columns
+            msg.full_text = msg.to_irc()
+        return msg
+
+    def add_message(self, message: Message):
+        self.history.add(message)
+        self.write_queue.put((
+            "sql",
+            "INSERT INTO messages (full_text, tags, nick, user, host, command, middle_params, trailing, "
+            "channel, ts, in_history, network) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (message.full_text, message.tags, message.nick, message.user, message.host, message.command,
+             message.middle_params, message.trailing, message.channel, self._next_ts(),
+             int(is_history_command(message.command)), message.network),
+            time.monotonic() if stats.enabled else 0,
+        ))
+
+    def save_connection_state(self, network: str, nick: str, channels) -> None:
+        self.write_queue.put((
+            "sql",
+            "INSERT INTO connection_state (network, nick, channels, ts) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (network) DO UPDATE SET nick = excluded.nick, channels = excluded.channels, ts = excluded.ts",
+            (network, nick, json.dumps(sorted(channels)), self._next_ts()),
+            time.monotonic() if stats.enabled else 0,
+        ))
+
+    def load_connection_state(self, network: str):
+        # (nick, channels) last saved for the network, or None
+        with self.read_lock:
+            row = self.read_conn.execute(
+                "SELECT nick, channels FROM connection_state WHERE network = ?", (network,)).fetchone()
+        if row is None:
+            return None
+        return row["nick"], json.loads(row["channels"])
+
+    def warm_channels(self, network: str, channels) -> None:
+        # Loads history for channels the startup warm-up did not reach, so the
+        # first prompt in a quiet channel does not scan the table
+        for channel in channels:
+            if len(self.history.get(self.history.capacity, channel, network)) >= self.history.capacity:
+                continue
+            messages = self._query_message_history(self.history.capacity, channel, network)
+            self.history.fill(network, channel, list(reversed(messages)))
+
+    def get_message_history(self, context_window: int = 10, channel=None, network=""):
+        if context_window <= self.history.capacity:
+            return self.history.get(context_window, channel, network)
+        return self._query_message_history(context_window, channel, network)
+
+    def _query_message_history(self, context_window: int, channel=None, network=""):
+        with self.read_lock:
+            if channel is None:
+                self.read_cursor.execute(
+                    "SELECT * FROM messages WHERE in_history = 1 AND network = ? ORDER BY id DESC LIMIT ?",
+                    (network, context_window))
+            else:
+                self.read_cursor.execute(
+                    "SELECT * FROM messages WHERE in_history = 1 AND network = ? AND channel = ? "
+                    "ORDER BY id DESC LIMIT ?",
+                    (network, channel, context_window))
+            return [self._row_to_message(row) for row in self.read_cursor.fetchall()]
+
+    def search_messages(self, match: str, network="", channel=None, limit: int = 5, budget_ms=None):
+        # Best FTS5 matches for `match`, or [] when the query runs past budget_ms
+        if not self.fts_enabled:
+            return []
+        sql = ("SELECT messages.* FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ? AND messages.network = ?")
+        params = [match, network]
+        if channel is not None:
+            sql += " AND messages.channel = ?"
+            params.append(channel)
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        params.append(limit)
+        with self.read_lock:
+            if budget_ms is not None:
+                deadline = time.monotonic() + budget_ms / 1000
+                self.read_conn.set_progress_handler(lambda: int(time.monotonic() > deadline), 1000)
+            try:
+                rows = self.read_conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                if "interrupted" not in str(e):
+                    raise
+                rows = []
+                if stats.enabled:
+                    stats.incr("retrieval.timeouts")
+            finally:
+                if budget_ms is not None:
+                    self.read_conn.set_progress_handler(None, 0)
+        return [self._row_to_message(row) for row in rows]
+
+    def stop(self, timeout: float = 10):
+        self.flush(timeout)
         self.running = False
-        self.worker.join(timeout=2)
+        self.worker.join(timeout=timeout)
         self.write_conn.close()
         self.read_conn.close()
+        with Database._lock:
+            # A later Database() opens a fresh instance instead of this closed one
+            if Database._instance is self:
+                Database._instance = None
+
+
+def enable_incremental_vacuum(db_path: str) -> bool:
+    # Converting an existing file needs one full VACUUM, which holds the write
+    # lock for as long as it takes to rewrite the file. Run it offline, with
+    # Lain stopped; files created since migrations exist are already converted.
+    conn = sqlite3.connect(db_path)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        log.info("db", "db.vacuum_converting", path=db_path)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
@@ -0,0 +1,197 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque, OrderedDict
+from Log import log
+from Stats import stats
+
+DEFAULT_PRIORITIES = {
+    "send_message": 0,
+    "irc_message": 1,
+    "llm_response": 1,
+    "llm_prompt": 2,
+}
+LOWEST_PRIORITY = 3
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-low-priority")
+
+
+def event_channel(event):
+    data = event.data if isinstance(event.data, dict) else {}
+    msg = data.get("message") or data.get("trigger_msg")
+    return (msg.network, msg.channel) if msg else None
+
+
+class EventQueue:
+    # Bounded priority queue. Events sharing an ordering key (type, channel) are
+    # handed out one at a time, in arrival order; different keys run in parallel.
+    def __init__(self, maxsize: int = 1000, overflow: str = "block", priorities=None) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        if priorities:
+            self.priorities.update(priorities)
+
+        self.pending = OrderedDict()
+        self.lanes = {}
+        self.busy = set()
+        self.ready = []
+        self.counter = itertools.count()
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.local = threading.local()
+
+    def qsize(self) -> int:
+        with self.lock:
+            return len(self.pending)
+
+    def put(self, event) -> bool:
+        priority = self.priorities.get(event.type, LOWEST_PRIORITY)
+        key = (event.type, event_channel(event))
+        if stats.enabled:
+            event.queued_at = time.monotonic()
+            stats.incr(f"events.{event.type}")
+        with self.lock:
+            while len(self.pending) >= self.maxsize:
+                if self.overflow == "block":
+                    # Workers producing follow-up events must never wait on
+                    # themselves, so they are allowed to overshoot the bound.
+                    if getattr(self.local, "worker", False):
+                        break
+                    self.not_full.wait()
+                elif self.overflow == "drop-oldest":
+                    self._evict(next(iter(self.pending)))
+                else:
+                    victim = self._lowest_priority()
+                    if victim is None or self.pending[victim][0] < priority:
+                        self.dropped += 1
+                        if stats.enabled:
+                            stats.incr(f"events.dropped.{event.type}")
+                        return False
+                    self._evict(victim)
+
+            seq = next(self.counter)
+            self.pending[seq] = (priority, key, event)
+            lane = self.lanes.setdefault(key, deque())
+            lane.append(seq)
+            if len(lane) == 1 and key not in self.busy:
+                heapq.heappush(self.ready, (priority, seq))
+                self.not_empty.notify()
+            return True
+
+    def get(self, timeout: float = None):
+        # Returns (key, event); the caller must hand the key back to task_done
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                while self.ready:
+                    _, seq = heapq.heappop(self.ready)
+                    entry = self.pending.get(seq)
+                    if entry is None:
+                        continue
+                    _, key, event = entry
+                    lane = self.lanes[key]
+                    if lane[0] != seq or key in self.busy:
+                        continue
+                    del self.pending[seq]
+                    lane.popleft()
+                    self.busy.add(key)
+                    self.not_full.notify()
+                    return key, event
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.not_empty.wait(remaining)
+
+    def task_done(self, key) -> None:
+        with self.lock:
+            self.busy.discard(key)
+            lane = self.lanes.get(key)
+            if lane:
+                head = lane[0]
+                heapq.heappush(self.ready, (self.pending[head][0], head))
+                self.not_empty.notify()
+            elif lane is not None:
+                del self.lanes[key]
+
+    def _lowest_priority(self):
+        victim = None
+        victim_priority = -1
+        for seq, (priority, _, _) in self.pending.items():
+            if priority > victim_priority:
+                victim, victim_priority = seq, priority
+        return victim
+
+    def _evict(self, seq) -> None:
+        priority, key, event = self.pending.pop(seq)
+        lane = self.lanes[key]
+        was_head = lane[0] == seq
+        lane.remove(seq)
+        self.dropped += 1
+        if stats.enabled:
+            stats.incr(f"events.dropped.{event.type}")
+        if not lane:
+            if key not in self.busy:
+                del self.lanes[key]
+        elif was_head and key not in self.busy:
+            head = lane[0]
+            heapq.heappush(self.ready, (self.pending[head][0], head))
+
+
+class Dispatcher:
+    def __init__(self, event_queue: EventQueue, handlers: dict, workers: int = 4) -> None:
+        self.event_queue = event_queue
+        self.handlers = handlers
+        self.workers = workers
+        self.threads = []
+        self.running = False
+        self.busy = 0
+        self.busy_lock = threading.Lock()
+
+    def start(self) -> None:
+        self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"dispatcher-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self) -> None:
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=2)
+        self.threads = []
+
+    def _work(self) -> None:
+        self.event_queue.local.worker = True
+        while self.running:
+            item = self.event_queue.get(timeout=1)
+            if item is None:
+                continue
+            key, event = item
+            with self.busy_lock:
+                self.busy += 1
+            started = time.monotonic() if stats.enabled else None
+            if started is not None and event.queued_at is not None:
+                stats.observe("event_queue", event.type, started - event.queued_at)
+                if event.received_at is not None:
+                    stats.observe("recv_to_dispatch", event.type, started - event.received_at)
+            try:
+                for handler in self.handlers.get(event.type, []):
+                    try:
+                        handler(event)
+                    except Exception as e:
+                        log.error("dispatcher", "dispatcher.handler_failed", event_type=event.type,
+                                  error=str(e))
+            finally:
+                self.event_queue.task_done(key)
+                with self.busy_lock:
+                    self.busy -= 1
+                if started is not None:
+                    elapsed = time.monotonic() - started
+                    stats.observe("handler", event.type, elapsed)
+                    stats.incr("dispatcher.busy_seconds", elapsed)
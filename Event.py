@@ -2,3 +2,6 @@ class Event:
     def __init__(self, type, data):
         self.type = type  
         self.data = data
+        # Only stamped while stats are enabled
+        self.received_at = None
+        self.queued_at = None
@@ -0,0 +1,120 @@
+import fnmatch
+import re
+import threading
+import time
+from collections import deque
+
+from Log import log
+from Stats import stats
+
+
+class TriggerGate:
+    # Decides, before any prompt work, whether an inbound line may trigger a
+    # reply. Rules run cheapest first and the first one to object wins; a rule
+    # is any callable (msg, network, now) returning a reason string to reject
+    # or None to pass, so deployments can add their own with add_rule().
+    #
+    # Budgets and cooldowns are driven by what the bot actually sends
+    # (note_sent), not by triggers, since the scheduler coalesces bursts of
+    # triggers into one reply.
+    def __init__(self, commands=("JOIN", "PRIVMSG", "421"), require_mention: bool = True, highlights=(),
+                 ignore=(), cooldown: float = 10.0, budget: int = 6, budget_window: float = 300.0) -> None:
+        self.commands = set(commands)
+        self.require_mention = require_mention
+        self.highlights = [word.lower() for word in highlights]
+        # nick!user@host glob patterns, matched case-insensitively
+        self.ignore = [pattern.lower() for pattern in ignore]
+        self.cooldown = cooldown
+        self.budget = budget
+        self.budget_window = budget_window
+        self.sent = {}
+        self.patterns = {}
+        self.lock = threading.Lock()
+        self.rules = [
+            self.check_command,
+            self.check_self,
+            self.check_ignore,
+            self.check_mention,
+            self.check_cooldown,
+            self.check_budget,
+        ]
+
+    def add_rule(self, rule) -> None:
+        self.rules.append(rule)
+
+    def allow(self, msg, network) -> bool:
+        now = time.monotonic()
+        reason = None
+        for rule in self.rules:
+            reason = rule(msg, network, now)
+            if reason is not None:
+                break
+        # Lines that were never candidates (NAMES, MODE, QUIT, ...) are most of
+        # the traffic; keep them out of the log unless gate debugging is on
+        level = "debug" if reason == "command" else "info"
+        log.log("gate", level, "gate.decision", allowed=reason is None, reason=reason or "ok", network=msg.network,
+                channel=msg.channel, nick=msg.nick, command=msg.command)
+        if stats.enabled:
+            stats.incr(f"gate.{reason or 'ok'}")
+        return reason is None
+
+    def note_sent(self, network_name: str, channel: str) -> None:
+        with self.lock:
+            sent = self.sent.get((network_name, channel))
+            if sent is None:
+                sent = self.sent[(network_name, channel)] = deque()
+            sent.append(time.monotonic())
+
+    def check_command(self, msg, network, now):
+        if msg.command not in self.commands:
+            return "command"
+        return None
+
+    def check_self(self, msg, network, now):
+        if msg.nick and msg.nick.lower() == network.nick.lower():
+            return "self"
+        return None
+
+    def check_ignore(self, msg, network, now):
+        if not self.ignore or not msg.nick:
+            return None
+        source = f"{msg.nick}!{msg.user or ''}@{msg.host or ''}".lower()
+        for pattern in self.ignore:
+            if fnmatch.fnmatchcase(source, pattern):
+                return "ignored"
+        return None
+
+    def check_mention(self, msg, network, now):
+        # Only channel chatter needs to address us; queries always do
+        if not self.require_mention or msg.command != "PRIVMSG" or msg.query or not msg.channel:
+            return None
+        if self.mention_pattern(network.nick).search(msg.trailing or ""):
+            return None
+        return "not addressed"
+
+    def mention_pattern(self, nick: str):
+        pattern = self.patterns.get(nick)
+        if pattern is None:
+            words = [nick.lower()] + self.highlights
+            pattern = re.compile(r"(?<![\w\[\]\\`^{}|-])(?:" + "|".join(re.escape(w) for w in words)
+                                 + r")(?![\w\[\]\\`^{}|-])", re.IGNORECASE)
+            self.patterns[nick] = pattern
+        return pattern
+
+    def check_cooldown(self, msg, network, now):
+        with self.lock:
+            sent = self.sent.get((msg.network, msg.channel))
+            if sent and now - sent[-1] < self.cooldown:
+                return "cooldown"
+        return None
+
+    def check_budget(self, msg, network, now):
+        with self.lock:
+            sent = self.sent.get((msg.network, msg.channel))
+            if not sent:
+                return None
+            while sent and now - sent[0] > self.budget_window:
+                sent.popleft()
+            if len(sent) >= self.budget:
+                return "rate budget"
+        return None
@@ -0,0 +1,126 @@
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Log import log
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+
+
+class BackendPool:
+    # Least-outstanding-requests balancing over Ollama-compatible endpoints,
+    # sharing one pooled session. Endpoints that fail max_failures times in a
+    # row are skipped until the health check sees them answer again.
+    def __init__(self, urls, concurrency: int = 1, timeout=(5, 120), max_failures: int = 2,
+                 health_interval: float = 15.0, health_path: str = "/api/tags") -> None:
+        if isinstance(urls, str):
+            urls = [urls]
+        if not urls:
+            raise ValueError("BackendPool needs at least one endpoint")
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.health_path = health_path
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=max(concurrency, 1))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.lock = threading.Lock()
+        self.running = True
+        self.health_worker = threading.Thread(target=self._health_loop, daemon=True)
+        self.health_worker.start()
+
+    def stop(self) -> None:
+        self.running = False
+        self.health_worker.join(timeout=2)
+        self.session.close()
+
+    @contextmanager
+    def post(self, payload, stream: bool = False):
+        tried = set()
+        while True:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                raise BackendUnavailable(f"No LLM endpoint could serve the request, tried {len(tried)}")
+            tried.add(endpoint)
+            try:
+                resp = self.session.post(endpoint.url, json=payload, stream=stream, timeout=self.timeout)
+                if resp.status_code >= 500:
+                    resp.close()
+                    resp.raise_for_status()
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                log.warning("llm", "llm.endpoint_failed", endpoint=endpoint.url, error=str(e))
+                self._release(endpoint, ok=False)
+                continue
+            break
+
+        try:
+            with resp:
+                resp.raise_for_status()
+                yield resp
+        finally:
+            self._release(endpoint, ok=True)
+
+    def _acquire(self, tried):
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in tried and e.healthy]
+            if not candidates:
+                # Everything is marked down; probing beats refusing outright
+                candidates = [e for e in self.endpoints if e not in tried]
+            if not candidates:
+                return None
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.requests))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(self, endpoint: Endpoint, ok: bool) -> None:
+        with self.lock:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.failures = 0
+                endpoint.healthy = True
+            else:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    endpoint.healthy = False
+
+    def _health_loop(self) -> None:
+        while self.running:
+            deadline = time.monotonic() + self.health_interval
+            while self.running and time.monotonic() < deadline:
+                time.sleep(0.5)
+            if not self.running:
+                return
+            for endpoint in self.endpoints:
+                self._check(endpoint)
+
+    def _check(self, endpoint: Endpoint) -> None:
+        try:
+            resp = self.session.get(urljoin(endpoint.url, self.health_path), timeout=self.timeout[0])
+            healthy = resp.status_code < 500
+            resp.close()
+        except requests.RequestException:
+            healthy = False
+        with self.lock:
+            endpoint.healthy = healthy
+            if healthy:
+                endpoint.failures = 0
@@ -1,6 +1,12 @@
-import requests
+import json
 import threading
+import time
 import queue
+from LLMBackend import BackendPool
+from Log import log
+from Prompt import PromptCache, estimate_tokens
+from ResponseCache import ResponseCache
+from Stats import stats
 from Message import Message
 from Event import Event
 
@@ -21,80 +27,154 @@ Just output the raw IRC command line.
 """
 
 class LLMInterface:
-    def __init__(self, event_callback, model: str = "gemma2:2b", endpoint: str = "http://localhost:11434/api/generate"):
+    def __init__(self, event_callback, model: str = "gemma2:2b", endpoint="http://localhost:11434/api/generate",
+                 stream: bool = True, concurrency: int = 1, timeout=(5, 120), keep_alive: str = "30m",
+                 num_ctx: int = 4096, reserve_output: int = 256, reserve_related: int = 256, estimator=estimate_tokens,
+                 cache_size: int = 256, cache_ttl: float = 600.0, cache_path=None, cache_bypass=()):
         self.model = model
-        self.endpoint = endpoint
+        self.endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint)
+        self.stream = stream
+        self.keep_alive = keep_alive
+        self.prompt_cache = PromptCache(SYSTEM_PROMPT, num_ctx=num_ctx, reserve_output=reserve_output,
+                                        estimator=estimator, reserve_related=reserve_related)
+        # cache_size=0 disables the response cache; cache_bypass lists trigger
+        # commands that always go to the model
+        self.response_cache = ResponseCache(cache_size, cache_ttl, persist_path=cache_path) if cache_size else None
+        self.cache_bypass = set(cache_bypass)
         self.event_callback = event_callback
+        self.backend = BackendPool(self.endpoints, concurrency=concurrency, timeout=timeout)
 
         self.request_queue = queue.Queue()
+        self.busy = 0
+        self.busy_lock = threading.Lock()
         self.running = True
-        self.worker = threading.Thread(target=self._process_requests, daemon=True)
-        self.worker.start()
+        self.workers = []
+        for _ in range(concurrency):
+            worker = threading.Thread(target=self._process_requests, daemon=True)
+            worker.start()
+            self.workers.append(worker)
 
-        self.num_ctx = 4096
+        self.num_ctx = num_ctx
         self.temperature = 0.9
         self.repeat_last_n = -1
         self.stop_sequences = ["Instructions", "###", "user:", "Lain:", "**", "\n"]
 
     def stop(self):
         self.running = False
-        self.worker.join(timeout=2)
+        for worker in self.workers:
+            worker.join(timeout=2)
+        self.backend.stop()
+        if self.response_cache:
+            self.response_cache.close()
 
     def _process_requests(self):
         while self.running:
             try:
-                last_message, msg_history = self.request_queue.get(timeout=1)
-                response = self._query_llm(last_message, msg_history)
+                last_message, msg_history, related, queued_at = self.request_queue.get(timeout=1)
+                if stats.enabled:
+                    stats.observe("llm_queue", None, time.monotonic() - queued_at)
+                with self.busy_lock:
+                    self.busy += 1
+                try:
+                    response = self._query_llm(last_message, msg_history, related)
+                finally:
+                    with self.busy_lock:
+                        self.busy -= 1
                 event = Event(
                     type="llm_response",
-                    data={"message": response})
+                    data={"message": response, "trigger_msg": last_message})
                 self.event_callback(event)
                 self.request_queue.task_done()
             except queue.Empty:
                 continue
             except Exception as e:
-                print(f"LLM process error: {e}")
+                log.error("llm", "llm.process_error", error=str(e))
 
-    def _query_llm(self, last_message, msg_history) -> Message:
+    def _query_llm(self, last_message, msg_history, related=()) -> Message:
         try:
-            # Build a plain text prompt from the history
-            # Prepend the system prompt
-            prompt_parts = [SYSTEM_PROMPT, "\n\nCurrent IRC chat log:\n"]
-            if msg_history[-1].full_text != last_message.full_text:
-                msg_history.insert(0, last_message)
-            for msg in reversed(msg_history):
-                role = msg.nick
-                parts = [msg.command, msg.middle_params, msg.trailing]
-                content = " ".join(p for p in parts if p and p != "None")
-                prompt_parts.append(f"{role}: {content}")
-
-            # Join into final prompt string
-            full_prompt = "\n".join(prompt_parts)
-            full_prompt += "\n\nNext command: "
+            key = (last_message.network, last_message.channel)
+            cache_key = None
+            if self.response_cache and last_message.command not in self.cache_bypass:
+                cache_key = self.response_cache.fingerprint(self.model, self._sampling_params(), key, msg_history)
+                cached = self.response_cache.get(cache_key)
+                if cached is not None:
+                    return Message.from_command(cached, nick = "Lain")
+
+            full_prompt, usage = self.prompt_cache.build(key, last_message, msg_history, related)
             payload = {
                 "model": self.model,
                 "prompt": full_prompt,
+                "keep_alive": self.keep_alive,
                 "num_ctx": self.num_ctx,
                 "temperature": self.temperature,
                 "repeat_last_n": self.repeat_last_n,
                 "stop": self.stop_sequences,
-                "stream": False,
+                "stream": self.stream,
             }
 
-            print(payload)
-            resp = requests.post(self.endpoint, json=payload, stream=False)
-            resp.raise_for_status()
-            data = resp.json()
-            print(data)
+            log.info("llm", "llm.request", model=self.model, network=key[0], channel=key[1],
+                     prompt_chars=len(full_prompt), related=len(related))
+            log.debug("llm", "llm.payload", payload=payload)
+            started = time.monotonic()
+            first_token = None
+            with self.backend.post(payload, stream=self.stream) as resp:
+                if self.stream:
+                    text_response, first_token = self._read_stream(resp, started)
+                else:
+                    data = resp.json()
+                    log.debug("llm", "llm.reply", data=data)
+                    text_response = data.get("response", "")
+            timings = {
+                "time_to_first_token": first_token,
+                "total": time.monotonic() - started,
+            }
+            log.info("llm", "llm.timings", network=key[0], channel=key[1], timings=timings, usage=usage)
+            if stats.enabled:
+                stats.observe("llm_http", None, timings["total"])
+                if first_token is not None:
+                    stats.observe("llm_first_token", None, first_token)
 
-            text_response = data.get("response", "").strip().split("\n")[0]
+            text_response = text_response.strip().split("\n")[0]
             text_response = text_response.lstrip(":.")  # strip leading ':' or '.'
             text_response = text_response.replace("COMMAND ", "")
-            return Message.from_command(text_response, nick = "Lain")
+            response = Message.from_command(text_response, nick = "Lain")
+            if cache_key is not None:
+                self.response_cache.put(cache_key, text_response)
+            return response
 
         except Exception as e:
-            print(f"LLM error: {e}")
+            log.error("llm", "llm.error", error=str(e))
             return Message()
+
+    def _sampling_params(self) -> dict:
+        return {
+            "num_ctx": self.num_ctx,
+            "temperature": self.temperature,
+            "repeat_last_n": self.repeat_last_n,
+            "stop": self.stop_sequences,
+        }
+
+    def _read_stream(self, resp, started):
+        # Ollama streams one JSON object per line. Stop reading as soon as a
+        # complete non-empty line has been produced; leaving the with-block
+        # in _query_llm closes the connection and the backend stops generating.
+        text = ""
+        first_token = None
+        for raw in resp.iter_lines():
+            if not raw:
+                continue
+            data = json.loads(raw)
+            piece = data.get("response", "")
+            if piece:
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                text += piece
+                if "\n" in text.lstrip():
+                    break
+            if data.get("done"):
+                break
+        return text, first_token
+
     # def _query_llm(self, last_message, msg_history) -> Message:
     #     try:
     #         messages_payload = [{"role": "system", "content": SYSTEM_PROMPT}]
@@ -126,5 +206,5 @@ class LLMInterface:
     #         print(f"LLM error: {e}")
     #         return Message()
 
-    def generate_response(self, last_message, msg_history):
-        self.request_queue.put((last_message, msg_history))
+    def generate_response(self, last_message, msg_history, related=()):
+        self.request_queue.put((last_message, msg_history, related, time.monotonic()))
@@ -1,32 +1,73 @@
-import queue
 import threading
+import time
 import DB
+from Dispatcher import Dispatcher, EventQueue
+from Log import log, message_fields
 from LLMInterface import LLMInterface
+from Network import Network, DEFAULT_NETWORK, load_config
+from PromptScheduler import PromptScheduler
+from Retention import Retention
+from Retrieval import Retriever
+from Stats import stats
 from Message import Message
 from Event import Event
-import irc_socket
+from Gate import TriggerGate
 
 class Lain:
-    def __init__(self, ip, port, nick, realname, username, logging=True) -> None:
-        self.event_queue = queue.Queue()
+    def __init__(self, ip=None, port=None, nick="Lain", realname="And I am me.", username="lain", logging=True,
+                 transport="thread", workers=4, queue_size=1000, overflow="block", priorities=None,
+                 debounce=1.5, prompt_deadline=30.0, llm_endpoints=None, llm_concurrency=1,
+                 networks=None, db_path="chat.db", llm_options=None, retention=None, retrieval=None,
+                 gate=None) -> None:
+        self.event_queue = EventQueue(maxsize=queue_size, overflow=overflow, priorities=priorities)
         self.running = True
         self.handlers = {}
-        self.ip = ip
-        self.port = port
-        self.nick = nick
-        self.realname = realname
-        self.username = username
+        self.dispatcher = Dispatcher(self.event_queue, self.handlers, workers=workers)
+        if networks is None:
+            networks = [Network(DEFAULT_NETWORK, ip, port, nick, realname, username, transport=transport)]
+        # Every connection shares the event bus, database and LLM backend pool;
+        # messages carry their network name so history and replies stay apart.
+        self.networks = {network.name: network for network in networks}
         self.logging = logging
         self.prompting_commands = ["JOIN", "PRIVMSG", "421"]
+        # TriggerGate keyword arguments; lines it rejects never become prompts
+        self.gate = TriggerGate(**{"commands": self.prompting_commands, **(gate or {})})
+        # Upper bound on history handed to the prompt builder, which trims it to its token budget
+        self.context_window = 200
 
-        self.irc_socket = None 
         self.llm_interface = None
-        self.db = DB.Database()
+        self.debounce = debounce
+        self.prompt_deadline = prompt_deadline
+        self.prompt_scheduler = None
+        self.llm_endpoints = llm_endpoints or ["http://localhost:11434/api/generate"]
+        self.llm_concurrency = llm_concurrency
+        # Extra LLMInterface keyword arguments, e.g. response cache settings
+        self.llm_options = llm_options or {}
+        self.db = DB.Database(db_path)
+        # Retention keyword arguments; None leaves the chat log untouched
+        self.retention_options = retention
+        self.retention = None
+        # Retriever keyword arguments for pulling older relevant lines into
+        # prompts; False turns retrieval off
+        self.retriever = Retriever(self.db, **(retrieval or {})) if retrieval is not False else None
+        self.restore_connection_state()
         self.register_handler("irc_message", lambda e: self.handle_irc_message(e))
         self.register_handler("send_message", lambda e: self.handle_send_message(e))
         self.register_handler("llm_prompt", lambda e: self.handle_llm_prompt(e))
         self.register_handler("llm_response", lambda e: self.handle_llm_response(e))
 
+    @classmethod
+    def from_config(cls, path, **overrides):
+        config = load_config(path)
+        networks = [Network(**network) for network in config.pop("networks")]
+        config.update(overrides)
+        return cls(networks=networks, **config)
+
+    @property
+    def irc_socket(self):
+        # The first network's socket, for single-network callers
+        return next(iter(self.networks.values())).socket
+
     def register_handler(self, event_type, handler_func):
         if event_type not in self.handlers:
             self.handlers[event_type] = []
@@ -36,31 +77,51 @@ class Lain:
         self.event_queue.put(event)
 
     def event_loop(self):
+        self.dispatcher.start()
         while self.running:
-            try:
-                event = self.event_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-
-            if event.type in self.handlers:
-                for handler in self.handlers[event.type]:
-                    # handler(event)
-                    threading.Thread(target=handler, args=(event,), daemon=True).start()
-
-    def start(self):
-        self.irc_socket = self.start_irc_socket()
-        self.llm_interface = LLMInterface(self.create_event)
-        self.start_keyboard_listener()
+            time.sleep(1)
+        self.dispatcher.stop()
+
+    def restore_connection_state(self):
+        # Channels from the last run; their history is loaded now so the
+        # first prompts after a restart are served from memory. The saved
+        # nick is only a record: we always register with the configured one.
+        for network in self.networks.values():
+            state = self.db.load_connection_state(network.name)
+            if state is not None:
+                network.joined = set(state[1])
+            self.db.warm_channels(network.name, set(network.channels) | network.joined)
+
+    def start(self, keyboard=True):
+        for network in self.networks.values():
+            network.connect(self.create_event)
+        self.llm_interface = LLMInterface(self.create_event, endpoint=self.llm_endpoints,
+                                          concurrency=self.llm_concurrency, **self.llm_options)
+        self.prompt_scheduler = PromptScheduler(self.dispatch_prompt, debounce=self.debounce,
+                                                deadline=self.prompt_deadline,
+                                                max_in_flight=self.llm_concurrency)
+        if self.retention_options is not None:
+            self.retention = Retention(self.db.db_path, **self.retention_options)
+        if stats.enabled:
+            self.register_gauges()
+        if keyboard:
+            self.start_keyboard_listener()
         self.event_loop()
 
     def stop(self):
         self.running = False
-        if not self.irc_socket:
-            return
-        try:
-            self.irc_socket.close()
-        except Exception as e:
-            print(e)
+        self.dispatcher.stop()
+        if self.prompt_scheduler:
+            self.prompt_scheduler.stop()
+        if self.llm_interface:
+            self.llm_interface.stop()
+        if self.retention:
+            self.retention.stop()
+        for network in self.networks.values():
+            network.close()
+        # Last, so rows from the handlers and sockets above are committed
+        self.db.stop()
+        log.flush()
 
     def handle_irc_message(self, event):
         msg = event.data["message"]
@@ -68,54 +129,135 @@ class Lain:
             raise ValueError("Received IRC message event with no 'message' in event.data")
         self.db.add_message(message=msg)
         if self.logging:
-            print(msg)
+            log.info("lain", "irc.in", **message_fields(msg))
+        network = self.networks.get(msg.network)
+        if network is None:
+            return
+        self.track_connection_state(network, msg)
+        if not self.gate.allow(msg, network):
+            return
         llm_event = Event(
             type="llm_prompt",
             data={"trigger_msg": msg})
         self.create_event(llm_event)
 
+    def join_channels(self, network):
+        # Configured channels first, then any joined at runtime before a reconnect
+        channels = network.channels + sorted(network.joined - set(network.channels))
+        for channel in channels:
+            self.send_command(network, f"JOIN {channel}")
+
+    def send_command(self, network, command):
+        msg = Message.from_command(command, nick=network.nick, user=network.username)
+        msg.network = network.name
+        self.create_event(Event(type="send_message", data={"message": msg}))
+
+    def track_connection_state(self, network, msg):
+        # Follows our nick and channel membership and persists every change
+        command = msg.command
+        params = msg.middle_params.split() if msg.middle_params else []
+        if command == "001":
+            if params:
+                network.nick = params[0]
+            network.registered()
+            self.join_channels(network)
+        elif command == "433" and len(params) > 1:
+            # Nick in use while registering
+            self.send_command(network, f"NICK {params[1]}_")
+            return
+        elif msg.nick != network.nick:
+            if command == "KICK" and len(params) > 1 and params[1] == network.nick:
+                network.joined.discard(params[0])
+            else:
+                return
+        elif command == "JOIN":
+            network.joined.add(msg.channel)
+        elif command == "PART":
+            network.joined.discard(msg.channel)
+        elif command == "NICK":
+            network.nick = msg.trailing or (params[0] if params else network.nick)
+        else:
+            return
+        self.db.save_connection_state(network.name, network.nick, network.joined)
+
     def handle_send_message(self, event):
         msg = event.data["message"]
         if not msg:
             raise ValueError("Received IRC message event with no 'message' in event.data")
-        if not self.irc_socket:
-            raise RuntimeError("IRC socket is not initialized or already closed")
-        self.irc_socket.send_message(msg)
+        network = self.networks.get(msg.network)
+        if not network or not network.socket or not network.socket.running:
+            raise RuntimeError(f"IRC socket for network {msg.network!r} is not connected")
+        network.socket.send_message(msg)
+        msg.resolve_query(outbound=True)
+        if msg.command in ("PRIVMSG", "NOTICE"):
+            self.gate.note_sent(msg.network, msg.channel)
         self.db.add_message(message=msg)
         if self.logging:
-            print(msg)
+            log.info("lain", "irc.out", **message_fields(msg))
 
     def handle_llm_prompt(self, event):
         last_msg = event.data["trigger_msg"]
         if not last_msg:
             return
         if last_msg.command in self.prompting_commands:
-            msg_history = self.db.get_message_history(context_window=30)
-            self.llm_interface.generate_response(last_msg, msg_history)
+            self.prompt_scheduler.submit((last_msg.network, last_msg.channel), last_msg)
+
+    def register_gauges(self):
+        stats.register_gauge("event_queue", self.event_queue.qsize)
+        stats.register_gauge("db_write_queue", self.db.write_queue.qsize)
+        stats.register_gauge("llm_request_queue", self.llm_interface.request_queue.qsize)
+        stats.register_gauge("prompts_pending", lambda: len(self.prompt_scheduler.pending))
+        stats.register_gauge("dispatcher_utilization", lambda: self.dispatcher.busy / max(self.dispatcher.workers, 1))
+        stats.register_gauge("llm_utilization", lambda: self.llm_interface.busy / max(len(self.llm_interface.workers), 1))
+
+    def dispatch_prompt(self, key, last_msg):
+        network, channel = key
+        started = time.monotonic() if stats.enabled else None
+        msg_history = self.db.get_message_history(context_window=self.context_window, channel=channel,
+                                                  network=network)
+        if started is not None:
+            stats.observe("history", None, time.monotonic() - started)
+        related = self.retriever.retrieve(last_msg) if self.retriever else ()
+        self.llm_interface.generate_response(last_msg, msg_history, related)
 
 
     def handle_llm_response(self, event):
         msg = event.data["message"]
-        print(msg)
+        trigger_msg = event.data.get("trigger_msg")
+        if trigger_msg is not None:
+            self.prompt_scheduler.complete((trigger_msg.network, trigger_msg.channel))
+            network = self.networks.get(trigger_msg.network)
+            msg.network = trigger_msg.network
+            if network:
+                msg.nick = network.nick
+        log.info("lain", "llm.response", **message_fields(msg))
         event = Event(
             type="send_message",
             data={"message": msg}
         )
         self.create_event(event)
-    def start_irc_socket(self):
-        sock = irc_socket.IRCSocket(self.ip, self.port, self.nick, self.realname, self.username, self.create_event)
-        sock.connect()
-        return sock
 
     def start_keyboard_listener(self):
+        # "@network COMMAND ..." picks a network, otherwise the first one is used
+        default_network = next(iter(self.networks.values()))
+
         def keyboard_listener():
             while True:
                 user_input = input()
                 if not user_input.strip():
                     continue
+                network = default_network
+                if user_input.startswith("@"):
+                    name, _, user_input = user_input[1:].partition(" ")
+                    network = self.networks.get(name)
+                    if network is None:
+                        print(f"Unknown network {name!r}")
+                        continue
+                msg = Message.from_command(user_input, nick=network.nick, user=network.username)
+                msg.network = network.name
                 event = Event(
                     type="send_message",
-                    data={"message": Message.from_command(user_input, nick=self.nick, user=self.username)}
+                    data={"message": msg}
                 )
                 self.create_event(event)
 
@@ -0,0 +1,153 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+def message_fields(msg) -> dict:
+    return {
+        "network": msg.network,
+        "tags": msg.tags,
+        "nick": msg.nick,
+        "user": msg.user,
+        "host": msg.host,
+        "command": msg.command,
+        "middle_params": msg.middle_params,
+        "trailing": msg.trailing,
+    }
+
+
+class Log:
+    # Structured JSON-lines log. Callers only build a dict and enqueue it; a
+    # background thread serializes, writes and rotates. Records below the
+    # component's level are dropped before any work is done, records of a
+    # sampled event are kept with the configured probability, and when the
+    # queue is full new records are dropped and counted rather than blocking.
+    def __init__(self) -> None:
+        self.level = LEVELS["info"]
+        self.components = {}
+        self.sample = {}
+        self.path = None
+        self.max_bytes = 0
+        self.backups = 3
+        self.queue = queue.Queue(maxsize=10000)
+        self.dropped = 0
+        self.file = None
+        self.size = 0
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def configure(self, level: str = "info", components=None, sample=None, path=None,
+                  max_bytes: int = 0, backups: int = 3, queue_size: int = 10000) -> None:
+        # components maps a component to its own level, sample maps an event
+        # name to the fraction of its records kept; max_bytes=0 never rotates
+        self.level = LEVELS[level]
+        self.components = {name: LEVELS[value] for name, value in (components or {}).items()}
+        self.sample = dict(sample or {})
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(maxsize=queue_size)
+
+    def enabled_for(self, component: str, level: str) -> bool:
+        return LEVELS[level] >= self.components.get(component, self.level)
+
+    def log(self, component: str, level: str, event: str, **fields) -> None:
+        if LEVELS[level] < self.components.get(component, self.level):
+            return
+        rate = self.sample.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        fields["ts"] = time.time()
+        fields["level"] = level
+        fields["component"] = component
+        fields["event"] = event
+        if self.writer is None:
+            self._start()
+        try:
+            self.queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, component: str, event: str, **fields) -> None:
+        self.log(component, "debug", event, **fields)
+
+    def info(self, component: str, event: str, **fields) -> None:
+        self.log(component, "info", event, **fields)
+
+    def warning(self, component: str, event: str, **fields) -> None:
+        self.log(component, "warning", event, **fields)
+
+    def error(self, component: str, event: str, **fields) -> None:
+        self.log(component, "error", event, **fields)
+
+    def flush(self, timeout: float = 5) -> None:
+        # Waits until every record queued so far has been written
+        if self.writer is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _start(self) -> None:
+        with self.lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._run, daemon=True)
+                self.writer.start()
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            lines = [record]
+            # Drain whatever else is waiting and write it in one go
+            while len(lines) < 500:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            taken = len(lines)
+            if self.dropped:
+                lines.append({"ts": time.time(), "level": "warning", "component": "log",
+                              "event": "log.dropped", "count": self.dropped})
+                self.dropped = 0
+            try:
+                self._write("".join(json.dumps(line, ensure_ascii=False, default=str) + "\n" for line in lines))
+            except Exception as e:
+                sys.stderr.write(f"Log write error: {e}\n")
+            for _ in range(taken):
+                self.queue.task_done()
+
+    def _write(self, text: str) -> None:
+        if self.path is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+            return
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            self.size = self.file.tell()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text.encode("utf-8"))
+        if self.max_bytes and self.size >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        # chat.log -> chat.log.1 -> ... -> chat.log.<backups>, oldest dropped
+        self.file.close()
+        self.file = None
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+log = Log()
@@ -1,15 +1,100 @@
 import json
 import re
 
-IRC_MSG_PATTERN = re.compile(r'^(?:@(?P<tags>[^\r\n ]*) +|())(?:[:](?P<nick>[^\s!@]+)(?:!(?P<user>[^\s@]+))?(?:@(?P<host>[^\s]+))? +|())(?P<command>[^\r\n ]+)(?: +(?P<middle_params>[^:\r\n ]+[^\r\n ]*(?: +[^:\r\n ]+[^\r\n ]*)*)|())?(?: +:(?P<trailing>[^\r\n]*)| +())?[\r\n]*$') 
 COMMAND_MSG_PATTERN = re.compile(r'^(?P<command>[A-Za-z]+)(?: +(?P<middle_params>[^\s]+))?(?: +(?P<trailing>.*))?$')
 
+CHANNEL_PREFIXES = "#&+!"
+# Which parameter names the channel, by command; named commands not listed
+# target their first parameter, numerics not listed carry no channel. User
+# modes (MODE Lain +i, 221) would otherwise pass for '+' channels.
+CHANNEL_PARAM = {
+    "INVITE": 1, "341": 2, "353": 2,
+    "324": 1, "329": 1, "331": 1, "332": 1, "333": 1, "366": 1, "367": 1, "368": 1,
+    "403": 1, "404": 1, "405": 1, "442": 1, "471": 1, "473": 1, "474": 1, "475": 1, "477": 1, "482": 1,
+}
+# Commands that can be sent to a nick instead of a channel
+PRIVATE_COMMANDS = {"PRIVMSG", "NOTICE"}
+TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
 class ParseError(Exception):
     pass
 
+
+def decode_tags(raw_tags) -> dict:
+    # IRCv3 message-tags: key[=value] pairs separated by ';', values escaped
+    tags = {}
+    if not raw_tags:
+        return tags
+    for item in raw_tags.split(";"):
+        if not item:
+            continue
+        key, sep, value = item.partition("=")
+        if "\\" in value:
+            out = []
+            i = 0
+            while i < len(value):
+                char = value[i]
+                if char == "\\":
+                    i += 1
+                    if i < len(value):
+                        out.append(TAG_ESCAPES.get(value[i], value[i]))
+                else:
+                    out.append(char)
+                i += 1
+            value = "".join(out)
+        tags[key] = value if sep else ""
+    return tags
+
+
+def parse_line(line: str):
+    # Returns (tags, nick, user, host, command, middle_params, trailing),
+    # with None for every part the line does not have. str.partition keeps
+    # the work in C; this runs once per received line.
+    tags = nick = user = host = None
+    rest = line
+    if rest.startswith("@"):
+        tags, space, rest = rest[1:].partition(" ")
+        if not space:
+            raise ParseError(f"Couldn't parse {line} into a message")
+        if rest.startswith(" "):
+            rest = rest.lstrip(" ")
+    if rest.startswith(":"):
+        prefix, space, rest = rest[1:].partition(" ")
+        if not space:
+            raise ParseError(f"Couldn't parse {line} into a message")
+        if rest.startswith(" "):
+            rest = rest.lstrip(" ")
+        if "@" in prefix:
+            prefix, _, host = prefix.partition("@")
+        if "!" in prefix:
+            prefix, _, user = prefix.partition("!")
+        if not prefix:
+            raise ParseError(f"Couldn't parse {line} into a message")
+        nick = prefix
+    command, _, rest = rest.partition(" ")
+    if not command:
+        raise ParseError(f"Couldn't parse {line} into a message")
+    trailing = None
+    if rest.startswith(" "):
+        rest = rest.lstrip(" ")
+    if rest.startswith(":"):
+        trailing = rest[1:]
+        rest = ""
+    else:
+        colon = rest.find(" :")
+        if colon != -1:
+            trailing = rest[colon + 2:]
+            rest = rest[:colon]
+    middle_params = (rest.rstrip(" ") if rest.endswith(" ") else rest) or None
+    return tags, nick, user, host, command, middle_params, trailing
+
+
 class Message:
-    def __init__(self, full_text = "", tags = "", nick = "", user = "", host = "", command = "", middle_params = "", trailing = ""):
-        self.tags = tags 
+    __slots__ = ("full_text", "tags", "nick", "user", "host", "command", "middle_params", "trailing",
+                 "network", "query", "_tag_dict", "rendered", "tokens")
+
+    def __init__(self, full_text = "", tags = None, nick = None, user = None, host = None, command = None, middle_params = None, trailing = None):
+        self.tags = tags
         self.nick = nick
         self.user = user
         self.host = host
@@ -17,27 +102,40 @@ class Message:
         self.middle_params = middle_params
         self.trailing = trailing
         self.full_text = full_text
+        self.network = ""
+        # The other party of a private conversation, see resolve_query()
+        self.query = None
+        self._tag_dict = None
+        self.rendered = None
+        self.tokens = None
 
     @classmethod
     def from_irc(cls, raw_line):
         raw_line = raw_line.strip()
-        match = IRC_MSG_PATTERN.match(raw_line)
-        if not match:
-            raise ParseError(f"Couldn't parse {raw_line} into a message")    
-        groups = match.groupdict()
-        return cls(
-            full_text = raw_line,
-            tags=str(groups.get("tags")),
-            nick=str(groups.get("nick")),
-            user=str(groups.get("user")),
-            host=str(groups.get("host")),
-            command=str(groups.get("command")),
-            middle_params=str(groups.get("middle_params")),
-            trailing=str(groups.get("trailing"))
-        )
+        if not raw_line:
+            raise ParseError(f"Couldn't parse {raw_line} into a message")
+        return cls(raw_line, *parse_line(raw_line))
+
+    @classmethod
+    def parse_many(cls, text: str, errors=None) -> list:
+        # Parses every complete line of a receive buffer; lines that fail to
+        # parse are skipped, and their ParseError is appended to `errors`.
+        messages = []
+        append = messages.append
+        parse = parse_line
+        for raw_line in text.split("\n"):
+            raw_line = raw_line.strip()
+            if not raw_line:
+                continue
+            try:
+                append(cls(raw_line, *parse(raw_line)))
+            except ParseError as e:
+                if errors is not None:
+                    errors.append(e)
+        return messages
 
     @classmethod
-    def from_command(cls, raw_line, tags = "", nick = "", user = "", host = "localhost"):
+    def from_command(cls, raw_line, tags = None, nick = None, user = None, host = "localhost"):
         raw_line = raw_line.strip()
         match = COMMAND_MSG_PATTERN.match(raw_line)
         if not match:
@@ -49,11 +147,60 @@ class Message:
             nick=nick,
             user=user,
             host=host,
-            command=str(groups.get("command")),
-            middle_params=str(groups.get("middle_params")),
-            trailing=str(groups.get("trailing"))
+            command=groups.get("command"),
+            middle_params=groups.get("middle_params"),
+            trailing=groups.get("trailing")
         )
 
+    def to_irc(self) -> str:
+        # Rebuilds a raw line from the parsed fields
+        parts = []
+        if self.tags is not None:
+            parts.append("@" + self.tags)
+        if self.nick:
+            prefix = ":" + self.nick
+            if self.user:
+                prefix += "!" + self.user
+            if self.host:
+                prefix += "@" + self.host
+            parts.append(prefix)
+        parts.append(self.command or "")
+        if self.middle_params:
+            parts.append(self.middle_params)
+        if self.trailing is not None:
+            parts.append(":" + self.trailing)
+        return " ".join(parts)
+
+    @property
+    def tag_dict(self) -> dict:
+        if self._tag_dict is None:
+            self._tag_dict = decode_tags(self.tags)
+        return self._tag_dict
+
+    @property
+    def channel(self) -> str:
+        # The channel, or for private messages the nick they are exchanged
+        # with, so every conversation has its own history and prompt key
+        command = self.command or ""
+        index = CHANNEL_PARAM.get(command, None if command.isdigit() else 0)
+        if index is not None:
+            params = self.middle_params.split() if self.middle_params else []
+            if command == "JOIN" and self.trailing:
+                params.append(self.trailing)
+            if index < len(params) and params[index][0] in CHANNEL_PREFIXES:
+                return params[index]
+        return self.query or ""
+
+    def resolve_query(self, outbound: bool = False) -> None:
+        # Inbound private messages come from the other party, outbound ones
+        # are addressed to it
+        if self.query is not None or self.command not in PRIVATE_COMMANDS or self.channel:
+            return
+        if outbound:
+            self.query = self.middle_params.split()[0] if self.middle_params else None
+        else:
+            self.query = self.nick
+
     def __str__(self) -> str:
         return json.dumps({
             "tags": self.tags,
@@ -0,0 +1,105 @@
+import json
+import random
+import threading
+import irc_socket
+from Log import log
+
+DEFAULT_NETWORK = ""
+
+
+class Network:
+    # One IRC connection: where to connect, who to be and what to join. When
+    # the server drops the connection it is re-established after a jittered
+    # exponential backoff; the delay only resets once the server welcomes us
+    # (registered()), so a server that accepts and immediately drops us is
+    # not hammered.
+    def __init__(self, name: str = DEFAULT_NETWORK, ip: str = "127.0.0.1", port: int = 6667, nick: str = "Lain",
+                 realname: str = "And I am me.", username: str = "lain", channels=None,
+                 transport: str = "thread", flood_rate: float = 1.0, flood_burst: int = 5,
+                 reconnect: bool = True, backoff_base: float = 1.0, backoff_max: float = 300.0) -> None:
+        self.name = name
+        self.ip = ip
+        self.port = int(port)
+        # Registration always asks for the configured nick; `nick` follows
+        # what the server actually gave us (433 fallbacks, NICK changes)
+        self.configured_nick = nick
+        self.nick = nick
+        self.realname = realname
+        self.username = username
+        self.channels = list(channels or [])
+        self.transport = transport
+        # Outbound flood limit: flood_burst lines at once, then flood_rate per second
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.reconnect = reconnect
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.attempt = 0
+        # Channels we are in, as seen from our own JOIN/PART/KICK echoes
+        self.joined = set()
+        self.event_callback = None
+        self.closing = threading.Event()
+        self.socket = None
+
+    def connect(self, event_callback):
+        self.event_callback = event_callback
+        self.nick = self.configured_nick
+        if self.transport == "asyncio":
+            socket_class = irc_socket.AsyncIRCSocket
+        else:
+            socket_class = irc_socket.IRCSocket
+        self.socket = socket_class(self.ip, self.port, self.configured_nick, self.realname, self.username, event_callback,
+                                   network=self.name, flood_rate=self.flood_rate, flood_burst=self.flood_burst,
+                                   on_disconnect=self._disconnected)
+        self.socket.connect()
+        return self.socket
+
+    def registered(self) -> None:
+        self.attempt = 0
+
+    def backoff_delay(self) -> float:
+        # Full exponential step with jitter down to half of it
+        delay = min(self.backoff_max, self.backoff_base * 2 ** self.attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _disconnected(self, sock) -> None:
+        if sock is not self.socket or not self.reconnect or self.closing.is_set():
+            return
+        threading.Thread(target=self._reconnect, daemon=True).start()
+
+    def _reconnect(self) -> None:
+        while not self.closing.is_set():
+            delay = self.backoff_delay()
+            self.attempt += 1
+            log.warning("network", "network.reconnecting", network=self.name, host=self.ip, delay=delay,
+                        attempt=self.attempt)
+            if self.closing.wait(delay):
+                return
+            try:
+                self.connect(self.event_callback)
+                return
+            except Exception as e:
+                log.warning("network", "network.reconnect_failed", network=self.name, host=self.ip, error=str(e))
+
+    def close(self):
+        self.closing.set()
+        if not self.socket:
+            return
+        try:
+            self.socket.close()
+        except Exception as e:
+            log.warning("network", "network.close_failed", network=self.name, error=str(e))
+
+
+def load_config(path: str) -> dict:
+    # {"networks": [{"name": ..., "ip": ..., "channels": [...]}, ...], plus
+    # optional top-level Lain keyword arguments such as "llm_endpoints"
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    networks = config.get("networks")
+    if not networks:
+        raise ValueError(f"Config {path} does not define any networks")
+    names = [n.get("name", DEFAULT_NETWORK) for n in networks]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Config {path} has duplicate network names: {names}")
+    return config
@@ -0,0 +1,143 @@
+import threading
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough BPE estimate: about four bytes per token for IRC-style text
+    return max(1, (len(text.encode("utf-8")) + 3) // 4)
+
+
+def render_line(msg) -> str:
+    # Rendered once per message and kept on the object
+    rendered = msg.rendered
+    if rendered is None:
+        parts = [msg.command, msg.middle_params, msg.trailing]
+        content = " ".join(p for p in parts if p)
+        rendered = f"{msg.nick}: {content}"
+        msg.rendered = rendered
+    return rendered
+
+
+class ChannelWindow:
+    def __init__(self) -> None:
+        self.messages = []
+        self.lines = []
+        self.tokens = 0
+
+
+class PromptCache:
+    # Builds prompts whose history section only ever grows at the end, so
+    # consecutive prompts for a channel share a byte-identical prefix and the
+    # backend can reuse its evaluated KV cache.
+    #
+    # History is sized in tokens: the budget is num_ctx minus the system
+    # prompt and the room reserved for the reply. Once appending would
+    # overflow it, the window is rebased to the newest lines filling
+    # `rebase_fill` of the budget, leaving room to append again.
+    #
+    # Older lines retrieved for the trigger go after the log, just before the
+    # footer, so they never disturb the shared prefix; they get their own
+    # `reserve_related` tokens out of num_ctx.
+    def __init__(self, system_prompt: str, num_ctx: int = 4096, reserve_output: int = 256,
+                 rebase_fill: float = 0.75, estimator=estimate_tokens, reserve_related: int = 256) -> None:
+        self.header = system_prompt + "\n\n\nCurrent IRC chat log:\n\n"
+        self.related_header = "\n\nEarlier related lines:\n"
+        self.footer = "\n\nNext command: "
+        self.estimator = estimator
+        self.related_budget = max(reserve_related - estimator(self.related_header), 0) if reserve_related else 0
+        self.budget = (num_ctx - reserve_output - reserve_related - estimator(self.header)
+                       - estimator(self.footer))
+        self.rebase_fill = rebase_fill
+        self.channels = {}
+        self.rebases = 0
+        self.appends = 0
+        self.lock = threading.Lock()
+
+    def line_tokens(self, msg) -> int:
+        # Cached on the message; one estimator is used per process
+        tokens = msg.tokens
+        if tokens is None:
+            tokens = self.estimator(render_line(msg) + "\n")
+            msg.tokens = tokens
+        return tokens
+
+    def build(self, channel, last_message, msg_history, related=()) -> tuple:
+        # msg_history is newest first, as returned by Database.get_message_history;
+        # related is best match first, as returned by Retriever.retrieve.
+        # Returns the prompt and how much of the budget this call used.
+        history = list(reversed(msg_history))
+        if not any(m is last_message or m.full_text == last_message.full_text for m in history[-3:]):
+            history.append(last_message)
+
+        with self.lock:
+            state = self.channels.get(channel)
+            if state is None:
+                state = self.channels[channel] = ChannelWindow()
+            new_messages = self._new_since(state, history)
+            new_tokens = sum(self.line_tokens(m) for m in new_messages) if new_messages is not None else 0
+            if new_messages is None or state.tokens + new_tokens > self.budget:
+                self.rebases += 1
+                self._rebase(state, history)
+            else:
+                self.appends += 1
+                state.messages.extend(new_messages)
+                state.lines.extend(render_line(m) for m in new_messages)
+                state.tokens += new_tokens
+            related_lines = self._related_lines(state, related)
+            usage = {
+                "budget": self.budget,
+                "used": state.tokens,
+                "lines": len(state.lines),
+                "fraction": state.tokens / self.budget if self.budget > 0 else 1.0,
+                "related": len(related_lines),
+            }
+            if related_lines:
+                return (self.header + "\n".join(state.lines) + self.related_header
+                        + "\n".join(related_lines) + self.footer), usage
+            return self.header + "\n".join(state.lines) + self.footer, usage
+
+    def _related_lines(self, state: ChannelWindow, related) -> list:
+        # Retrieved lines not already in the window, up to the related budget
+        if not related or self.related_budget <= 0:
+            return []
+        seen = set(state.lines)
+        lines = []
+        tokens = 0
+        for msg in related:
+            line = render_line(msg)
+            if line in seen:
+                continue
+            cost = self.line_tokens(msg)
+            if tokens + cost > self.related_budget:
+                break
+            seen.add(line)
+            lines.append(line)
+            tokens += cost
+        return lines
+
+    def _rebase(self, state: ChannelWindow, history) -> None:
+        # Fill newest first up to the rebase target
+        target = self.budget * self.rebase_fill
+        selected = []
+        tokens = 0
+        for msg in reversed(history):
+            cost = self.line_tokens(msg)
+            if selected and tokens + cost > target:
+                break
+            selected.append(msg)
+            tokens += cost
+        selected.reverse()
+        state.messages = selected
+        state.lines = [render_line(m) for m in selected]
+        state.tokens = tokens
+
+    @staticmethod
+    def _new_since(state: ChannelWindow, history):
+        # Messages in history after the last one already in the window, or
+        # None when the window no longer lines up with the history.
+        if not state.messages:
+            return None
+        last = state.messages[-1]
+        for i in range(len(history) - 1, -1, -1):
+            if history[i] is last:
+                return history[i + 1:]
+        return None
@@ -0,0 +1,99 @@
+import threading
+import time
+from Log import log
+from Stats import stats
+
+
+class PromptScheduler:
+    # Keeps at most one pending prompt per channel. A newer trigger replaces
+    # the pending one; a channel is dispatched once it has been quiet for
+    # `debounce` seconds (or waited `max_delay`), and only when it has no
+    # generation in flight. Triggers older than `deadline` are dropped.
+    def __init__(self, dispatch, debounce: float = 1.5, max_delay: float = 5.0, deadline: float = 30.0,
+                 max_in_flight: int = 1) -> None:
+        self.dispatch = dispatch
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.max_in_flight = max_in_flight
+
+        self.pending = {}
+        self.in_flight = {}
+        self.coalesced = 0
+        self.dropped = 0
+        self.dispatched = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, channel, trigger_msg) -> None:
+        now = time.monotonic()
+        with self.condition:
+            entry = self.pending.get(channel)
+            if entry:
+                self.coalesced += 1
+                if stats.enabled:
+                    stats.incr("prompts.coalesced")
+                self.pending[channel] = (trigger_msg, entry[1], now)
+            else:
+                self.pending[channel] = (trigger_msg, now, now)
+            self.condition.notify()
+
+    def complete(self, channel) -> None:
+        with self.condition:
+            self.in_flight.pop(channel, None)
+            self.condition.notify()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.worker.join(timeout=2)
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                ready, wait = self._collect(time.monotonic())
+                if not ready:
+                    self.condition.wait(wait)
+                    continue
+            for channel, trigger_msg in ready:
+                try:
+                    self.dispatch(channel, trigger_msg)
+                except Exception as e:
+                    log.error("scheduler", "scheduler.dispatch_failed", channel=channel, error=str(e))
+                    self.complete(channel)
+
+    def _collect(self, now):
+        # Called with the condition held; returns the channels to dispatch and
+        # how long to sleep before anything else can become ready.
+        for channel, started in list(self.in_flight.items()):
+            if now - started > self.deadline:
+                del self.in_flight[channel]
+
+        ready = []
+        wait = 1.0
+        for channel, (trigger_msg, first_seen, last_seen) in list(self.pending.items()):
+            if now - last_seen > self.deadline:
+                del self.pending[channel]
+                self.dropped += 1
+                if stats.enabled:
+                    stats.incr("prompts.dropped")
+                continue
+            if channel in self.in_flight or len(self.in_flight) >= self.max_in_flight:
+                continue
+            due = min(last_seen + self.debounce, first_seen + self.max_delay)
+            if due > now:
+                wait = min(wait, due - now)
+                continue
+            del self.pending[channel]
+            self.in_flight[channel] = now
+            self.dispatched += 1
+            if stats.enabled:
+                stats.observe("prompt_wait", None, now - first_seen)
+                stats.incr("prompts.dispatched")
+            ready.append((channel, trigger_msg))
+        return ready, wait
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from Prompt import render_line
+from Stats import stats
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_line(msg) -> str:
+    return WHITESPACE.sub(" ", render_line(msg)).strip().lower()
+
+
+class ResponseCache:
+    # LRU of generated replies with a TTL, optionally backed by a SQLite file
+    # so entries survive restarts. Keys are fingerprints built by fingerprint().
+    def __init__(self, max_entries: int = 256, ttl: float = 600.0, window: int = 4, persist_path=None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.window = window
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.conn = None
+        if persist_path:
+            self.conn = sqlite3.connect(persist_path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            self.conn.commit()
+
+    def fingerprint(self, model: str, params: dict, key, msg_history) -> str:
+        # msg_history is newest first; only the trailing `window` lines count
+        lines = [normalize_line(msg) for msg in msg_history[:self.window]]
+        blob = json.dumps([model, params, list(key), lines], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                response, created = entry
+                if now - created <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self._record("hit")
+                    return response
+                del self.entries[key]
+            if self.conn is not None:
+                row = self.conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    if now - row[1] <= self.ttl:
+                        self._store(key, row[0], row[1])
+                        self._record("persistent_hit")
+                        return row[0]
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.conn.commit()
+            self._record("miss")
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self.lock:
+            self._store(key, response, now)
+            if self.conn is not None:
+                self.conn.execute("INSERT OR REPLACE INTO responses (key, response, created) VALUES (?, ?, ?)",
+                                  (key, response, now))
+                self.conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                self.conn.commit()
+
+    def _store(self, key: str, response: str, created: float) -> None:
+        self.entries[key] = (response, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _record(self, outcome: str) -> None:
+        if outcome == "hit":
+            self.hits += 1
+        elif outcome == "persistent_hit":
+            self.persistent_hits += 1
+        else:
+            self.misses += 1
+        if stats.enabled:
+            stats.incr(f"llm_cache.{outcome}")
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.persistent_hits) / lookups if lookups else None,
+        }
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
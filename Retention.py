@@ -0,0 +1,160 @@
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from Log import log
+from Message import Message
+
+DAY = 86400
+# Command classes, as stored in messages.in_history by the Database
+COMMAND_CLASSES = {"conversation": 1, "server": 0}
+
+
+class Retention:
+    # Background housekeeping for the chat log, on its own connection:
+    #   - rows past their retention are appended to gzipped JSON-lines files,
+    #     one per UTC day (archive_dir/messages-YYYY-MM-DD.jsonl.gz), then deleted
+    #   - rows older than compact_after lose their full_text, which can be
+    #     rebuilt from the parsed columns
+    #   - freed pages are returned with incremental vacuum, once the file
+    #     uses incremental auto-vacuum (DB.enable_incremental_vacuum, offline)
+    # Work is done in small transactions so the writer thread never waits long.
+    def __init__(self, db_path: str, archive_dir: str = "archive", default_days=None, class_days=None,
+                 channel_days=None, compact_after_days=None, interval: float = 600.0, chunk_size: int = 500,
+                 vacuum_pages: int = 1000) -> None:
+        # None keeps rows forever; channel rules win over class rules
+        self.archive_dir = archive_dir
+        self.default_days = default_days
+        self.class_days = dict(class_days or {})
+        self.channel_days = dict(channel_days or {})
+        unknown = set(self.class_days) - set(COMMAND_CLASSES)
+        if unknown:
+            raise ValueError(f"Unknown command classes {sorted(unknown)}, expected {sorted(COMMAND_CLASSES)}")
+        self.compact_after_days = compact_after_days
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.archived = 0
+        self.compacted = 0
+        self.vacuumed = 0
+        # ts of the newest row compacted so far; older rows are never revisited
+        self.compacted_ts = -1
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.incremental = self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        if not self.incremental:
+            log.warning("retention", "retention.vacuum_disabled", path=db_path,
+                        hint="stop Lain and run main.py --enable-incremental-vacuum to return freed pages")
+        self.stopped = threading.Event()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.worker.join(timeout=10)
+        self.conn.close()
+
+    def _run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                log.error("retention", "retention.failed", error=str(e))
+            self.stopped.wait(self.interval)
+
+    def run_once(self) -> None:
+        now_us = int(time.time() * 1_000_000)
+        for where, params, days in self._rules():
+            if days is None:
+                continue
+            self._archive(where, params, now_us - int(days * DAY * 1_000_000))
+        if self.compact_after_days is not None:
+            self._compact(now_us - int(self.compact_after_days * DAY * 1_000_000))
+        if self.incremental and not self.stopped.is_set():
+            self._vacuum()
+
+    def _vacuum(self) -> None:
+        # execute() steps a pragma only once, which frees a single page;
+        # executescript() runs incremental_vacuum to completion
+        before = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        self.conn.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});")
+        freed = before - self.conn.execute("PRAGMA page_count").fetchone()[0]
+        self.vacuumed += freed
+        if freed:
+            log.info("retention", "retention.vacuumed", pages=freed)
+
+    def _rules(self):
+        # (WHERE clause, params, days) with every row covered by exactly one rule
+        channels = list(self.channel_days)
+        not_overridden = f"channel NOT IN ({','.join('?' * len(channels))})" if channels else "1"
+        for channel, days in self.channel_days.items():
+            yield "channel = ?", [channel], days
+        for name, days in self.class_days.items():
+            yield f"in_history = ? AND {not_overridden}", [COMMAND_CLASSES[name], *channels], days
+        classes = [COMMAND_CLASSES[name] for name in self.class_days]
+        default_where = not_overridden
+        if classes:
+            default_where += f" AND in_history NOT IN ({','.join('?' * len(classes))})"
+        yield default_where, [*channels, *classes], self.default_days
+
+    def _cutoff_id(self, cutoff_us: int) -> int:
+        # ts grows with id, so rows older than the cutoff all sit below the
+        # first newer row; bounding by id keeps the channel index search short
+        row = self.conn.execute(
+            "SELECT id FROM messages WHERE ts >= ? ORDER BY ts LIMIT 1", (cutoff_us,)).fetchone()
+        if row is not None:
+            return row["id"]
+        return (self.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+
+    def _archive(self, where: str, params, cutoff_us: int) -> None:
+        cutoff_id = self._cutoff_id(cutoff_us)
+        while not self.stopped.is_set():
+            rows = self.conn.execute(
+                f"SELECT * FROM messages WHERE id < ? AND ts < ? AND {where} ORDER BY id LIMIT ?",
+                (cutoff_id, cutoff_us, *params, self.chunk_size)).fetchall()
+            if not rows:
+                return
+            self._write_archive(rows)
+            ids = [row["id"] for row in rows]
+            with self.conn:
+                self.conn.execute(f"DELETE FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids)
+            self.archived += len(rows)
+            time.sleep(0.01)
+
+    def _write_archive(self, rows) -> None:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        segments = {}
+        for row in rows:
+            record = dict(row)
+            if not record["full_text"]:
+                msg = Message(tags=row["tags"], nick=row["nick"], user=row["user"], host=row["host"],
+                              command=row["command"], middle_params=row["middle_params"], trailing=row["trailing"])
+                record["full_text"] = msg.to_irc()
+            day = datetime.fromtimestamp(row["ts"] / 1_000_000, tz=timezone.utc).strftime("%Y-%m-%d")
+            segments.setdefault(day, []).append(json.dumps(record, ensure_ascii=False))
+        for day, lines in segments.items():
+            path = os.path.join(self.archive_dir, f"messages-{day}.jsonl.gz")
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+    def _compact(self, cutoff_us: int) -> None:
+        # Walks the ts index forward from where the last chunk ended
+        while not self.stopped.is_set():
+            rows = self.conn.execute(
+                "SELECT id, ts FROM messages WHERE ts > ? AND ts < ? AND full_text IS NOT NULL ORDER BY ts LIMIT ?",
+                (self.compacted_ts, cutoff_us, self.chunk_size)).fetchall()
+            if not rows:
+                return
+            ids = [row["id"] for row in rows]
+            with self.conn:
+                self.conn.execute(f"UPDATE messages SET full_text = NULL WHERE id IN ({','.join('?' * len(ids))})", ids)
+            # Rows sharing the last ts may remain; stop just short of it
+            self.compacted_ts = rows[-1]["ts"] - 1 if len(rows) == self.chunk_size else rows[-1]["ts"]
+            self.compacted += len(ids)
+            time.sleep(0.01)
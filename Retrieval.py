@@ -0,0 +1,74 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from Stats import stats
+
+WORD = re.compile(r"[^\W_]{4,}", re.UNICODE)
+STOPWORDS = {
+    "about", "after", "again", "also", "been", "before", "being", "could", "does", "doing", "down", "each",
+    "from", "have", "having", "here", "into", "just", "like", "more", "most", "much", "only", "other",
+    "over", "same", "should", "some", "such", "than", "that", "their", "them", "then", "there", "these",
+    "they", "this", "those", "very", "want", "were", "what", "when", "where", "which", "while", "will",
+    "with", "would", "your", "yeah", "okay",
+}
+
+
+def fts_quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+class Retriever:
+    # Pulls older lines relevant to a trigger out of the FTS5 index: its
+    # keywords and its author's nick, within the trigger's network and
+    # channel. Results are cached briefly per query so bursts of similar
+    # triggers only search once.
+    def __init__(self, db, top_k: int = 5, max_terms: int = 8, budget_ms: float = 30.0,
+                 cache_size: int = 256, cache_ttl: float = 60.0) -> None:
+        self.db = db
+        self.top_k = top_k
+        self.max_terms = max_terms
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def query_for(self, msg):
+        terms = []
+        for word in WORD.findall((msg.trailing or "").lower()):
+            if word not in STOPWORDS and word not in terms:
+                terms.append(word)
+            if len(terms) >= self.max_terms:
+                break
+        clauses = [fts_quote(term) for term in terms]
+        if msg.nick:
+            clauses.append("nick : " + fts_quote(msg.nick))
+        return " OR ".join(clauses) or None
+
+    def retrieve(self, msg) -> list:
+        query = self.query_for(msg)
+        if query is None:
+            return []
+        key = (msg.network, msg.channel, query)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and now - entry[1] <= self.cache_ttl:
+                self.cache.move_to_end(key)
+                if stats.enabled:
+                    stats.incr("retrieval.cache_hit")
+                return entry[0]
+        started = time.monotonic()
+        # Extra rows leave room for dropping lines already in the prompt window
+        results = self.db.search_messages(query, network=msg.network, channel=msg.channel,
+                                          limit=self.top_k * 3, budget_ms=self.budget_ms)
+        if stats.enabled:
+            stats.observe("retrieval", None, time.monotonic() - started)
+        with self.lock:
+            self.cache[key] = (results, now)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
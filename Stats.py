@@ -0,0 +1,182 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Log import log
+
+# Bucket upper bounds in seconds, 50us doubling up to ~14 minutes
+BUCKET_BOUNDS = [0.00005 * 2 ** i for i in range(25)]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p: float):
+        # Upper bound of the bucket holding the p-th percentile
+        if not self.count:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class Gauge:
+    def __init__(self, read) -> None:
+        self.read = read
+        self.last = 0
+        self.max = 0
+        self.total = 0
+        self.samples = 0
+
+    def sample(self) -> None:
+        try:
+            value = self.read()
+        except Exception:
+            return
+        self.last = value
+        self.max = max(self.max, value)
+        self.total += value
+        self.samples += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "last": self.last,
+            "max": self.max,
+            "mean": self.total / self.samples if self.samples else None,
+        }
+
+
+class Stats:
+    # Process-wide latency histograms, counters and sampled gauges. Disabled by
+    # default: instrumented code checks `stats.enabled` before doing any work.
+    def __init__(self) -> None:
+        self.enabled = False
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.interval = 1.0
+        self.snapshot_file = None
+        self.server = None
+        self.running = False
+        self.sampler = None
+
+    def enable(self, interval: float = 1.0, snapshot_file=None, port=None) -> None:
+        self.enabled = True
+        self.started = time.monotonic()
+        self.interval = interval
+        self.snapshot_file = snapshot_file
+        self.running = True
+        self.sampler = threading.Thread(target=self._run, daemon=True)
+        self.sampler.start()
+        if port is not None:
+            self._serve(port)
+
+    def stop(self) -> None:
+        self.running = False
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.sampler:
+            self.sampler.join(timeout=2)
+            self.sampler = None
+        if self.snapshot_file:
+            self._write_snapshot()
+
+    def observe(self, stage: str, event_type, seconds: float) -> None:
+        with self.lock:
+            for key in (stage, f"{stage}.{event_type}") if event_type else (stage,):
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(seconds)
+
+    def incr(self, name: str, amount: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def register_gauge(self, name: str, read) -> None:
+        with self.lock:
+            self.gauges[name] = Gauge(read)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "uptime": time.monotonic() - self.started,
+                "latency": {name: h.snapshot() for name, h in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": {name: g.snapshot() for name, g in sorted(self.gauges.items())},
+            }
+
+    def _run(self) -> None:
+        last_write = time.monotonic()
+        while self.running:
+            time.sleep(min(self.interval, 0.5))
+            with self.lock:
+                gauges = list(self.gauges.values())
+            for gauge in gauges:
+                gauge.sample()
+            if self.snapshot_file and time.monotonic() - last_write >= self.interval:
+                self._write_snapshot()
+                last_write = time.monotonic()
+
+    def _write_snapshot(self) -> None:
+        tmp_path = self.snapshot_file + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(tmp_path, self.snapshot_file)
+        except OSError as e:
+            log.warning("stats", "stats.snapshot_failed", path=self.snapshot_file, error=str(e))
+
+    def _serve(self, port: int) -> None:
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                body = json.dumps(stats.snapshot(), indent=2).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+stats = Stats()
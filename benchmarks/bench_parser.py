@@ -0,0 +1,93 @@
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Message import Message, ParseError
+
+# The parser Message.from_irc used before the hand-written one, kept as the baseline
+LEGACY_IRC_MSG_PATTERN = re.compile(r'^(?:@(?P<tags>[^\r\n ]*) +|())(?:[:](?P<nick>[^\s!@]+)(?:!(?P<user>[^\s@]+))?(?:@(?P<host>[^\s]+))? +|())(?P<command>[^\r\n ]+)(?: +(?P<middle_params>[^:\r\n ]+[^\r\n ]*(?: +[^:\r\n ]+[^\r\n ]*)*)|())?(?: +:(?P<trailing>[^\r\n]*)| +())?[\r\n]*$')
+
+FIELDS = ("tags", "nick", "user", "host", "command", "middle_params", "trailing")
+
+
+def legacy_parse(raw_line):
+    # Builds a Message like the old from_irc did, so both sides pay for the object
+    raw_line = raw_line.strip()
+    match = LEGACY_IRC_MSG_PATTERN.match(raw_line)
+    if not match:
+        raise ParseError(f"Couldn't parse {raw_line} into a message")
+    groups = match.groupdict()
+    return Message(raw_line, *(str(groups.get(field)) for field in FIELDS))
+
+
+def synthetic_traffic(count: int, seed: int = 1) -> list:
+    # Rough mix of a busy network during a netsplit and rejoin
+    rng = random.Random(seed)
+    nicks = [f"user{i}" for i in range(300)]
+    words = "the a of to irc server split rejoin ping hello lol anyone know why my build fails".split()
+    lines = []
+    for _ in range(count):
+        nick = rng.choice(nicks)
+        kind = rng.random()
+        if kind < 0.45:
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(1, 25)))
+            tags = f"@time=2024-05-0{rng.randint(1, 9)}T12:00:00.000Z;msgid=abc{rng.randint(0, 99999)};account={nick} " \
+                if rng.random() < 0.5 else ""
+            lines.append(f"{tags}:{nick}!~{nick}@host-{rng.randint(0, 999)}.example.net PRIVMSG #lain :{text}")
+        elif kind < 0.65:
+            lines.append(f":{nick}!~{nick}@host-{rng.randint(0, 999)}.example.net JOIN #lain")
+        elif kind < 0.8:
+            lines.append(f":{nick}!~{nick}@host.example.net QUIT :*.net *.split")
+        elif kind < 0.95:
+            names = " ".join(rng.choice("@+") + n if rng.random() < 0.1 else n for n in rng.sample(nicks, 40))
+            lines.append(f":irc.example.net 353 Lain = #lain :{names}")
+        else:
+            lines.append(f"PING :irc.example.net")
+    return lines
+
+
+def check_equivalence(lines) -> int:
+    mismatches = 0
+    for line in lines:
+        legacy = {field: getattr(legacy_parse(line), field) for field in FIELDS}
+        msg = Message.from_irc(line)
+        current = {field: str(getattr(msg, field)) for field in FIELDS}
+        if legacy != current:
+            mismatches += 1
+            print(f"Mismatch for {line!r}:\n  legacy  {legacy}\n  current {current}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser("Compare the IRC line parser against the legacy regex")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    lines = synthetic_traffic(args.lines)
+    buffer = "\r\n".join(lines) + "\r\n"
+    mismatches = check_equivalence(lines)
+
+    # Every case starts from the same receive buffer, as the transports do.
+    # Repeats are interleaved so a noisy moment hits all cases alike.
+    cases = {
+        "legacy regex": lambda: [legacy_parse(l) for l in buffer.split("\n") if l.strip()],
+        "Message.from_irc": lambda: [Message.from_irc(l) for l in buffer.split("\n") if l.strip()],
+        "Message.parse_many": lambda: Message.parse_many(buffer),
+    }
+    results = {name: float("inf") for name in cases}
+    for _ in range(args.repeat):
+        for name, case in cases.items():
+            results[name] = min(results[name], timeit.timeit(case, number=1))
+    baseline = results["legacy regex"]
+    print(f"{len(lines)} lines, {mismatches} mismatches against the legacy regex")
+    for name, seconds in results.items():
+        print(f"{name:20s} {len(lines) / seconds:12,.0f} lines/s  {baseline / seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
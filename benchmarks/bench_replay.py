@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DB
+from Lain import Lain
+from Log import log
+from Stats import stats
+from stubs import FakeIRCServer, FakeLLMServer
+
+REPLY_PREFIX = "PRIVMSG #bench :reply-"
+
+
+def synthetic_traffic(lines: int, scenario: str, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    nicks = [f"user{i}" for i in range(500)]
+    traffic = [":irc.bench 001 Lain :Welcome to the bench network"]
+    trigger = 0
+    while len(traffic) < lines:
+        kind = rng.random() if scenario == "mixed" else None
+        nick = rng.choice(nicks)
+        if scenario == "privmsg" or (kind is not None and kind < 0.5):
+            trigger += 1
+            traffic.append(f":{nick}!~{nick}@bench.host PRIVMSG #bench :message trig-{trigger} "
+                           + "lorem ipsum " * rng.randint(1, 10))
+        elif scenario == "join" or (kind is not None and kind < 0.75):
+            trigger += 1
+            traffic.append(f":{nick}!~{nick}@bench.host JOIN #bench trig-{trigger}")
+        elif scenario == "names" or (kind is not None and kind < 0.95):
+            traffic.append(f":irc.bench 353 Lain = #bench :" + " ".join(rng.sample(nicks, 60)))
+        else:
+            traffic.append(f"PING :bench-{len(traffic)}")
+        if scenario != "mixed" and len(traffic) % 50 == 0:
+            traffic.append(f"PING :bench-{len(traffic)}")
+    return traffic
+
+
+def percentiles(values, points=(50, 90, 99)) -> dict:
+    if not values:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(values)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+class Sampler:
+    def __init__(self, lain: Lain, interval: float = 0.05) -> None:
+        self.lain = lain
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_event_queue = 0
+        self.peak_write_queue = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while self.running:
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            self.peak_event_queue = max(self.peak_event_queue, self.lain.event_queue.qsize())
+            self.peak_write_queue = max(self.peak_write_queue, self.lain.db.write_queue.qsize())
+            time.sleep(self.interval)
+
+    def stop(self) -> None:
+        self.running = False
+        self.thread.join()
+
+
+def run(args) -> dict:
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            traffic = [line.rstrip("\r\n") for line in f if line.strip()]
+    else:
+        traffic = synthetic_traffic(args.lines, args.scenario)
+    expected = sum(1 for line in traffic if not line.startswith("PING"))
+
+    if args.stats:
+        stats.enable(interval=0.1)
+    workdir = tempfile.mkdtemp(prefix="lain-bench-")
+    DB.Database(os.path.join(workdir, "bench.db"))
+    irc = FakeIRCServer()
+    llm = FakeLLMServer(latency=args.llm_latency)
+    lain = Lain("127.0.0.1", irc.port, "Lain", "bench", "lain", logging=False, transport=args.transport,
+                workers=args.workers, debounce=args.debounce, llm_endpoints=[llm.url],
+                llm_concurrency=args.llm_concurrency,
+                # Every synthetic trigger should reach the scheduler, as before gating existed
+                gate={"require_mention": False, "cooldown": 0, "budget": 10 ** 9})
+
+    handled = [0]
+    ingest_done = threading.Event()
+    lock = threading.Lock()
+
+    def count(event):
+        with lock:
+            handled[0] += 1
+            if handled[0] >= expected:
+                ingest_done.set()
+
+    lain.register_handler("irc_message", count)
+    sampler = Sampler(lain)
+    threading.Thread(target=lain.start, kwargs={"keyboard": False}, daemon=True).start()
+
+    irc.connected.wait(timeout=10)
+    started = time.monotonic()
+    irc.send_lines(traffic, rate=args.rate)
+    ingest_done.wait(timeout=args.timeout)
+    ingested = time.monotonic()
+    lain.db.flush()
+    committed = time.monotonic()
+    time.sleep(args.settle)
+
+    sampler.stop()
+    lain.stop()
+    irc.close()
+    llm.close()
+    if args.stats:
+        stats.stop()
+
+    reply_latencies = []
+    for received_at, text in irc.received:
+        if text.startswith(REPLY_PREFIX):
+            sent = irc.trigger_sent.get(text[len(REPLY_PREFIX):].strip())
+            if sent is not None:
+                reply_latencies.append(received_at - sent)
+
+    elapsed = ingested - started
+    return {
+        "lines": len(traffic),
+        "handled": handled[0],
+        "ingest_seconds": elapsed,
+        "ingest_lines_per_second": handled[0] / elapsed if elapsed > 0 else None,
+        "db_write_lag_seconds": committed - ingested,
+        "ping_pong_latency": percentiles(irc.pong_latencies),
+        "pongs": len(irc.pong_latencies),
+        "triggers": len(irc.trigger_sent),
+        "llm_requests": llm.requests,
+        "replies": len(reply_latencies),
+        "trigger_to_reply_latency": percentiles(reply_latencies),
+        "peak_threads": sampler.peak_threads,
+        "peak_event_queue": sampler.peak_event_queue,
+        "peak_write_queue": sampler.peak_write_queue,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **({"stages": stats.snapshot()} if args.stats else {}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser("Replay IRC traffic through Lain against a fake IRC server and LLM backend")
+    parser.add_argument("--scenario", choices=["mixed", "privmsg", "join", "names"], default="mixed")
+    parser.add_argument("--replay", help="File with raw IRC lines to replay instead of synthetic traffic")
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=0, help="Lines per second, 0 for as fast as possible")
+    parser.add_argument("--transport", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--debounce", type=float, default=0.2)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--llm-concurrency", type=int, default=1)
+    parser.add_argument("--settle", type=float, default=3.0, help="Seconds to wait for replies after ingest")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--stats", action="store_true", help="Enable pipeline instrumentation and include it")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--log-file", default=os.devnull, help="Where Lain's structured log goes")
+    args = parser.parse_args()
+
+    log.configure(path=args.log_file)
+    report = run(args)
+
+    if args.json or args.stats:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = "  ".join(f"{k}={v * 1000:.1f}ms" if v is not None else f"{k}=n/a" for k, v in value.items())
+        elif isinstance(value, float):
+            value = f"{value:,.3f}"
+        print(f"{key:28s} {value}")
+
+
+if __name__ == "__main__":
+    main()
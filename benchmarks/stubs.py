@@ -0,0 +1,144 @@
+import json
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRIGGER_PATTERN = re.compile(r"trig-(\d+)")
+
+
+class FakeIRCServer:
+    # Single-client IRC server: replays lines to the bot and records what it
+    # sends back, with timestamps, so latencies can be computed afterwards.
+    def __init__(self, host: str = "127.0.0.1") -> None:
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, 0))
+        self.listener.listen(1)
+        self.host = host
+        self.port = self.listener.getsockname()[1]
+        self.client = None
+        self.connected = threading.Event()
+        self.received = []
+        self.ping_sent = {}
+        self.pong_latencies = []
+        self.trigger_sent = {}
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        self.client, _ = self.listener.accept()
+        self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connected.set()
+        buffer = b""
+        while self.running:
+            try:
+                data = self.client.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            buffer += data
+            *lines, buffer = buffer.split(b"\r\n")
+            now = time.monotonic()
+            for line in lines:
+                text = line.decode("utf-8", errors="replace")
+                if text.startswith("PONG"):
+                    token = text.rsplit(":", 1)[-1].strip()
+                    sent = self.ping_sent.pop(token, None)
+                    if sent is not None:
+                        self.pong_latencies.append(now - sent)
+                self.received.append((now, text))
+
+    def send_lines(self, lines, rate: float = 0) -> None:
+        # rate is lines per second, 0 sends as fast as the socket accepts
+        self.connected.wait()
+        interval = 1 / rate if rate else 0
+        batch = []
+        for line in lines:
+            if line.startswith("PING"):
+                self.ping_sent[line.rsplit(":", 1)[-1]] = time.monotonic()
+            else:
+                marker = TRIGGER_PATTERN.search(line)
+                if marker:
+                    self.trigger_sent[marker.group(1)] = time.monotonic()
+            if interval:
+                self.client.sendall((line + "\r\n").encode("utf-8"))
+                time.sleep(interval)
+            else:
+                batch.append(line)
+                if len(batch) >= 64:
+                    self.client.sendall(("\r\n".join(batch) + "\r\n").encode("utf-8"))
+                    batch = []
+        if batch:
+            self.client.sendall(("\r\n".join(batch) + "\r\n").encode("utf-8"))
+
+    def close(self) -> None:
+        self.running = False
+        for sock in (self.client, self.listener):
+            try:
+                if sock:
+                    sock.close()
+            except OSError:
+                pass
+
+
+class FakeLLMServer:
+    # Ollama-compatible /api/generate stub. Replies with a PRIVMSG naming the
+    # newest trig-<n> marker in the prompt, after `latency` seconds.
+    def __init__(self, latency: float = 0.2, channel: str = "#bench", host: str = "127.0.0.1") -> None:
+        self.latency = latency
+        self.channel = channel
+        self.requests = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                body = b'{"models": []}'
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self) -> None:
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with server.lock:
+                    server.requests += 1
+                time.sleep(server.latency)
+                markers = TRIGGER_PATTERN.findall(payload.get("prompt", ""))
+                marker = markers[-1] if markers else "none"
+                text = f"PRIVMSG {server.channel} reply-{marker}\n"
+                if payload.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    try:
+                        for piece in (text, ""):
+                            chunk = (json.dumps({"response": piece, "done": not piece}) + "\n").encode()
+                            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                        self.wfile.write(b"0\r\n\r\n")
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                else:
+                    body = json.dumps({"response": text, "done": True}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer((host, 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}/api/generate"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,10 +1,224 @@
+import asyncio
+import collections
+import queue
 import socket
 import threading
+import time
 from Event import Event
-from Message import Message, ParseError
+from Log import log
+from Message import Message
+from Stats import stats
+
+class LineBuffer:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        # Returns every complete line received so far as one block; a partial
+        # tail waits in the buffer for the next read
+        self.buffer.extend(data)
+        end = self.buffer.rfind(b"\n")
+        if end == -1:
+            return b""
+        block = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return block
+
+
+def pong_for(msg: Message) -> str:
+    if msg.trailing is not None:
+        return f"PONG :{msg.trailing}\r\n"
+    return f"PONG {msg.middle_params or ''}\r\n"
+
+
+# Commands whose last parameter is free text and must be sent as a trailing
+# ":" parameter; they are also the ones split when too long
+TEXT_COMMANDS = {"PRIVMSG", "NOTICE", "PART", "QUIT", "TOPIC", "AWAY"}
+# Sent ahead of queued chat lines and never held back by the flood bucket
+PRIORITY_COMMANDS = {"PONG", "PING", "PASS", "CAP", "NICK", "USER", "QUIT"}
+# Room a server needs for ":<host>" in the prefix it adds when relaying
+MAX_HOST = 63
+
+
+def format_line(message: Message) -> str:
+    return format_parts(message.command, message.middle_params, message.trailing)
+
+
+def format_parts(command, middle_params, trailing) -> str:
+    if trailing and (command or "").upper() in TEXT_COMMANDS and not trailing.startswith(":"):
+        trailing = ":" + trailing
+    parts = (command, middle_params, trailing)
+    return " ".join(p for p in parts if p) + "\r\n"
+
+
+def split_utf8(data: bytes, limit: int) -> list:
+    # Chunks of at most `limit` bytes, cut at a space when one is near the end
+    # and never inside a multi-byte character
+    chunks = []
+    while len(data) > limit:
+        cut = limit
+        while cut > 0 and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        if cut == 0:
+            # limit is narrower than the first character; send it whole
+            cut = 1
+            while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+                cut += 1
+        space = data.rfind(b" ", limit // 2, cut)
+        if space > 0:
+            chunks.append(data[:space])
+            data = data[space + 1:]
+        else:
+            chunks.append(data[:cut])
+            data = data[cut:]
+    if data or not chunks:
+        chunks.append(data)
+    return chunks
+
+
+def split_message(message: Message, max_bytes: int) -> list:
+    # One or more complete lines, each at most max_bytes before the CRLF
+    line = format_line(message)
+    if len(line.encode("utf-8")) - 2 <= max_bytes:
+        return [line]
+    command = (message.command or "").upper()
+    if command not in TEXT_COMMANDS or not message.trailing:
+        return [line]
+    trailing = message.trailing[1:] if message.trailing.startswith(":") else message.trailing
+    head = format_parts(message.command, message.middle_params, ":x")[:-3]
+    # Enough for any single UTF-8 character, however long the header
+    room = max(max_bytes - len(head.encode("utf-8")), 4)
+    return [format_parts(message.command, message.middle_params, ":" + chunk.decode("utf-8"))
+            for chunk in split_utf8(trailing.encode("utf-8"), room)]
+
+
+def message_target(message: Message) -> str:
+    return message.middle_params.split()[0] if message.middle_params else ""
+
+
+class OutboundScheduler:
+    # Single writer for one connection. Chat lines wait in per-target queues
+    # served round robin, so one busy channel cannot starve another, and are
+    # released by a token bucket shaped like an ircd flood limit: `burst`
+    # lines at once, then `rate` lines per second. Priority lines (PONG,
+    # registration) jump every queue and are written immediately, spending
+    # whatever tokens are left. `write` must write the whole buffer, e.g. sendall.
+    def __init__(self, write, rate: float = 1.0, burst: int = 5, network: str = "") -> None:
+        self.write = write
+        self.network = network
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.priority = collections.deque()
+        self.targets = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self) -> None:
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def send(self, line: str, target: str = "", priority: bool = False) -> None:
+        item = (line.encode("utf-8"), time.monotonic())
+        with self.condition:
+            if priority:
+                self.priority.append(item)
+            else:
+                lane = self.targets.get(target)
+                if lane is None:
+                    lane = self.targets[target] = collections.deque()
+                lane.append(item)
+            self.condition.notify()
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.priority) + sum(len(lane) for lane in self.targets.values())
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def _next(self):
+        # Called with the condition held; blocks until a line may be written
+        while self.running:
+            self._refill()
+            if self.priority:
+                # Priority lines drain the bucket but never push it into debt
+                self.tokens = max(self.tokens - 1, 0.0)
+                return self.priority.popleft()
+            if self.targets:
+                if self.tokens >= 1:
+                    target, lane = next(iter(self.targets.items()))
+                    item = lane.popleft()
+                    del self.targets[target]
+                    if lane:
+                        # Back of the rotation
+                        self.targets[target] = lane
+                    self.tokens -= 1
+                    return item
+                self.condition.wait((1 - self.tokens) / self.rate)
+            else:
+                self.condition.wait()
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                item = self._next()
+            if item is None:
+                return
+            data, queued_at = item
+            try:
+                self.write(data)
+            except Exception as e:
+                log.warning("network", "network.write_failed", network=self.network, error=str(e))
+                self.running = False
+                return
+            if stats.enabled:
+                stats.observe("send_wait", None, time.monotonic() - queued_at)
+                stats.incr("irc.lines_out")
+
+
+def parse_lines(block: bytes, network: str = "") -> list:
+    if not block:
+        return []
+    started = time.monotonic() if stats.enabled else None
+    errors = []
+    messages = Message.parse_many(block.decode("utf-8", errors="ignore"), errors)
+    for e in errors:
+        log.warning("network", "network.parse_error", network=network, error=str(e))
+    if started is not None:
+        stats.observe("parse", None, time.monotonic() - started)
+        stats.incr("irc.lines_in", len(messages))
+        stats.incr("irc.parse_errors", len(errors))
+    return messages
+
+
+def message_event(msg: Message, received_at, network) -> Event:
+    msg.network = network
+    msg.resolve_query()
+    event = Event(
+        type="irc_message",
+        data={"message": msg})
+    event.received_at = received_at
+    return event
+
 
 class IRCSocket:
-    def __init__(self, ip, port, nick, realname, username, event_callback) -> None:
+    def __init__(self, ip, port, nick, realname, username, event_callback, network="",
+                 flood_rate: float = 1.0, flood_burst: int = 5, on_disconnect=None) -> None:
+        self.network = network
+        # Called with the socket when the server side goes away, not on close()
+        self.on_disconnect = on_disconnect
         self.ip = ip
         self.port = port
         self.nick = nick
@@ -13,58 +227,215 @@ class IRCSocket:
         self.event_callback = event_callback
         self.socket = None
         self.running = False
+        self.max_line = 510 - len(f":{nick}!{username}@") - MAX_HOST
+        self.outbound = OutboundScheduler(self._sendall, rate=flood_rate, burst=flood_burst, network=network)
 
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.connect((self.ip, self.port))
+        self.outbound.start()
 
-        self.socket.send(f"USER {self.username} 0 * :{self.realname}\r\n".encode("utf-8"))
-        self.socket.send(f"nick {self.nick}\r\n".encode("utf-8"))
+        self.outbound.send(f"USER {self.username} 0 * :{self.realname}\r\n", priority=True)
+        self.outbound.send(f"nick {self.nick}\r\n", priority=True)
 
         self.running = True
         threading.Thread(target=self._receive_messages, daemon=True).start()
 
     def _receive_messages(self) -> None:
+        buffer = LineBuffer()
         while self.running:
             if not self.socket:
                 self.running = False
                 raise ConnectionError("IRC Socket is not initialized")
             try:
-                response = self.socket.recv(2048).decode("utf-8", errors="ignore")
-                if not response:
-                    print("Disconnected from server.")
+                data = self.socket.recv(2048)
+                if not data:
+                    log.warning("network", "network.disconnected", network=self.network)
                     break
 
-                lines = response.strip().split("\r\n")
-                for line in lines:
-                    if line.startswith("PING"):
-                        pong_response = "PONG " + line.split()[1] + "\r\n"
-                        self.socket.send(pong_response.encode("utf-8"))
+                received_at = time.monotonic() if stats.enabled else None
+                for msg in parse_lines(buffer.feed(data), self.network):
+                    if msg.command == "PING":
+                        self.outbound.send(pong_for(msg), priority=True)
                     else:
-                        msg = Message.from_irc(line)
-                        event = Event(
-                        type="irc_message",
-                        data={"message": msg})
-                        self.event_callback(event)
-            except ParseError as e:
-                print(f"Error: {e}")
-                continue
+                        self.event_callback(message_event(msg, received_at, self.network))
             except Exception as e:
-                print(f"Error: {e}")
+                log.warning("network", "network.receive_failed", network=self.network, error=str(e))
                 break
+        self._disconnected()
+
+    def _disconnected(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        self.outbound.stop()
+        try:
+            self.socket.close()
+        except Exception as e:
+            log.warning("network", "network.close_failed", network=self.network, error=str(e))
+        if self.on_disconnect:
+            self.on_disconnect(self)
+
+    def _sendall(self, data: bytes) -> None:
+        self.socket.sendall(data)
 
     def send_message(self, message: Message) -> None:
         if not self.socket:
             self.running = False
             raise ConnectionError("IRC Socket is not initialized")
-        try: 
-            self.socket.send((f"{message.command} {message.middle_params} {message.trailing}" + "\r\n").encode("utf-8"))
-        except Exception as e:
-            print(e)
+        priority = (message.command or "").upper() in PRIORITY_COMMANDS
+        target = message_target(message)
+        for line in split_message(message, self.max_line):
+            self.outbound.send(line, target, priority)
 
     def close(self):
         self.running = False
+        self.outbound.stop()
         try:
             self.socket.close()
         except Exception as e:
-            print(e)
+            log.warning("network", "network.close_failed", network=self.network, error=str(e))
+
+
+class AsyncIRCSocket:
+    # Same surface as IRCSocket, but reads and writes run on a private asyncio loop
+    def __init__(self, ip, port, nick, realname, username, event_callback, network="",
+                 read_size: int = 65536, flood_rate: float = 1.0, flood_burst: int = 5,
+                 on_disconnect=None) -> None:
+        self.network = network
+        self.on_disconnect = on_disconnect
+        self.ip = ip
+        self.port = port
+        self.nick = nick
+        self.realname = realname
+        self.username = username
+        self.event_callback = event_callback
+        self.read_size = read_size
+        self.loop = None
+        self.loop_thread = None
+        self.receive_task = None
+        # Parsed events go to a delivery thread, so a blocking event_callback
+        # (EventQueue in "block" mode) never stalls the loop and its PONGs
+        self.inbound = queue.SimpleQueue()
+        self.delivery_thread = None
+        self.reader = None
+        self.writer = None
+        self.running = False
+        self.max_line = 510 - len(f":{nick}!{username}@") - MAX_HOST
+        # The scheduler thread paces lines and hands each to the loop to write
+        self.outbound = OutboundScheduler(self._schedule_write, rate=flood_rate, burst=flood_burst,
+                                          network=network)
+
+    def connect(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.loop_thread.start()
+        self.delivery_thread = threading.Thread(target=self._deliver, daemon=True)
+        self.delivery_thread.start()
+        future = asyncio.run_coroutine_threadsafe(self._connect(), self.loop)
+        try:
+            future.result()
+        except Exception:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            raise
+
+    def _deliver(self) -> None:
+        # Hands events over in arrival order; None ends the thread
+        while True:
+            event = self.inbound.get()
+            if event is None:
+                return
+            self.event_callback(event)
+
+    def _run_loop(self) -> None:
+        # Each connection gets its own loop; closing it here, once it has
+        # stopped, releases its selector and self-pipe
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            self.inbound.put(None)
+
+    async def _close_writer(self) -> None:
+        if not self.writer:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+    async def _shutdown(self) -> None:
+        await self._close_writer()
+        if self.receive_task and self.receive_task is not asyncio.current_task():
+            # The closed transport ends the read; cancel it if it hangs anyway
+            try:
+                await asyncio.wait_for(self.receive_task, 1)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        self.loop.stop()
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        self.outbound.start()
+        self.outbound.send(f"USER {self.username} 0 * :{self.realname}\r\n", priority=True)
+        self.outbound.send(f"nick {self.nick}\r\n", priority=True)
+        self.running = True
+        self.receive_task = self.loop.create_task(self._receive_messages())
+
+    async def _receive_messages(self) -> None:
+        buffer = LineBuffer()
+        while self.running:
+            try:
+                data = await self.reader.read(self.read_size)
+            except Exception as e:
+                log.warning("network", "network.receive_failed", network=self.network, error=str(e))
+                break
+            if not data:
+                log.warning("network", "network.disconnected", network=self.network)
+                break
+            received_at = time.monotonic() if stats.enabled else None
+            for msg in parse_lines(buffer.feed(data), self.network):
+                self._handle_message(msg, received_at)
+        if not self.running:
+            return
+        self.running = False
+        self.outbound.stop()
+        await self._close_writer()
+        self.loop.stop()
+        if self.on_disconnect:
+            self.on_disconnect(self)
+
+    def _handle_message(self, msg: Message, received_at=None) -> None:
+        if msg.command == "PING":
+            self.outbound.send(pong_for(msg), priority=True)
+            return
+        self.inbound.put(message_event(msg, received_at, self.network))
+
+    def _write(self, data: bytes) -> None:
+        # Loop thread only; the transport buffers and flushes without blocking
+        if not self.writer or self.writer.is_closing():
+            return
+        self.writer.write(data)
+
+    def _schedule_write(self, data: bytes) -> None:
+        self.loop.call_soon_threadsafe(self._write, data)
+
+    def send_message(self, message: Message) -> None:
+        if not self.loop or not self.writer:
+            self.running = False
+            raise ConnectionError("IRC Socket is not initialized")
+        priority = (message.command or "").upper() in PRIORITY_COMMANDS
+        target = message_target(message)
+        for line in split_message(message, self.max_line):
+            self.outbound.send(line, target, priority)
+
+    def close(self):
+        self.running = False
+        self.outbound.stop()
+        if not self.loop or self.loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        except Exception as e:
+            log.warning("network", "network.close_failed", network=self.network, error=str(e))
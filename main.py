@@ -1,10 +1,21 @@
 import argparse
+import DB
 from Lain import Lain
+from Network import load_config
+from Log import log, LEVELS
+from Stats import stats
 
 LOGGING = True
 
-def main(ip, port, nick, realname, username):
-    lain = Lain(ip, port, nick, realname, username, LOGGING)
+def main(ip, port, nick, realname, username, transport, workers, queue_size, overflow, debounce, prompt_deadline,
+         llm_endpoints, llm_concurrency, config=None, llm_options=None):
+    if config:
+        lain = Lain.from_config(config, logging=LOGGING)
+    else:
+        lain = Lain(ip, port, nick, realname, username, LOGGING, transport,
+                    workers=workers, queue_size=queue_size, overflow=overflow,
+                    debounce=debounce, prompt_deadline=prompt_deadline,
+                    llm_endpoints=llm_endpoints, llm_concurrency=llm_concurrency, llm_options=llm_options)
     try:
         lain.start()  
     except KeyboardInterrupt:
@@ -18,6 +29,56 @@ if __name__ == "__main__":
     parser.add_argument('--nick', help='IRC client\'s nick', default='Lain')
     parser.add_argument('--realname', help='IRC client\'s realname', default='And I am me.')
     parser.add_argument('--username', help='IRC client\'s username', default='lain')
+    parser.add_argument('--transport', help='IRC transport implementation', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--workers', help='Number of event handler threads', type=int, default=4)
+    parser.add_argument('--queue-size', help='Maximum number of queued events', type=int, default=1000)
+    parser.add_argument('--overflow', help='What to do when the event queue is full',
+                        choices=['block', 'drop-oldest', 'drop-low-priority'], default='block')
+    parser.add_argument('--debounce', help='Seconds a channel must be quiet before prompting the model',
+                        type=float, default=1.5)
+    parser.add_argument('--prompt-deadline', help='Seconds after which an unanswered trigger is dropped',
+                        type=float, default=30.0)
+    parser.add_argument('--llm-endpoint', help='Ollama-compatible generate URL, may be given several times',
+                        action='append', dest='llm_endpoints')
+    parser.add_argument('--llm-concurrency', help='Number of generations in flight at once', type=int, default=1)
+    parser.add_argument('--llm-cache-size', help='Cached LLM replies kept in memory, 0 disables the cache',
+                        type=int, default=256)
+    parser.add_argument('--llm-cache-ttl', help='Seconds a cached LLM reply stays valid', type=float, default=600.0)
+    parser.add_argument('--llm-cache-path', help='SQLite file that persists cached LLM replies across restarts')
+    parser.add_argument('--llm-cache-bypass', help='Trigger command that never uses the cache, may be repeated',
+                        action='append', default=[])
+    parser.add_argument('--config', help='JSON file describing several networks; other connection options are ignored')
+    parser.add_argument('--stats-port', help='Serve pipeline stats as JSON on this local port', type=int)
+    parser.add_argument('--stats-file', help='Periodically write pipeline stats to this JSON file')
+    parser.add_argument('--stats-interval', help='Seconds between stats samples and snapshots',
+                        type=float, default=5.0)
+    parser.add_argument('--log-level', help='Default structured log level', choices=list(LEVELS), default='info')
+    parser.add_argument('--log-component', help='Per-component log level as component=level, may be repeated',
+                        action='append', default=[])
+    parser.add_argument('--log-sample', help='Fraction of an event\'s records kept as event=rate, may be repeated',
+                        action='append', default=[])
+    parser.add_argument('--log-file', help='Write JSON-lines logs to this file instead of stdout')
+    parser.add_argument('--log-max-bytes', help='Rotate the log file once it reaches this size, 0 never rotates',
+                        type=int, default=0)
+    parser.add_argument('--log-backups', help='Rotated log files kept', type=int, default=3)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='Convert the database so retention can return freed pages, then exit; run with Lain stopped')
     args = parser.parse_args()
-    main(args.ip, args.port, args.nick, args.realname, args.username)
+    log.configure(level=args.log_level,
+                  components=dict(item.split('=', 1) for item in args.log_component),
+                  sample={event: float(rate) for event, rate in (item.split('=', 1) for item in args.log_sample)},
+                  path=args.log_file, max_bytes=args.log_max_bytes, backups=args.log_backups)
+    if args.enable_incremental_vacuum:
+        db_path = load_config(args.config).get('db_path', 'chat.db') if args.config else 'chat.db'
+        if not DB.enable_incremental_vacuum(db_path):
+            print(f"{db_path} already uses incremental auto-vacuum")
+        log.flush()
+        raise SystemExit(0)
+    if args.stats_port is not None or args.stats_file:
+        stats.enable(interval=args.stats_interval, snapshot_file=args.stats_file, port=args.stats_port)
+    main(args.ip, args.port, args.nick, args.realname, args.username, args.transport,
+         args.workers, args.queue_size, args.overflow, args.debounce, args.prompt_deadline,
+         args.llm_endpoints, args.llm_concurrency, args.config,
+         {"cache_size": args.llm_cache_size, "cache_ttl": args.llm_cache_ttl,
+          "cache_path": args.llm_cache_path, "cache_bypass": args.llm_cache_bypass})
 